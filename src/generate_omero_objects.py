@@ -5,15 +5,24 @@
 
 import ezomero
 from ome_types import to_xml
-from typing import List, Tuple, Union
+from typing import List, Set, Tuple, Union
 from omero.model import DatasetI, IObject, PlateI, WellI, WellSampleI, ImageI
-from omero.gateway import DatasetWrapper
+from omero.model import ProjectI, ScreenI, TagAnnotationI, MapAnnotationI
+from omero.model import CommentAnnotationI, TimestampAnnotationI
+from omero.model import LongAnnotationI, FileAnnotationI
+from omero.model import ProjectAnnotationLinkI, DatasetAnnotationLinkI
+from omero.model import ImageAnnotationLinkI, ScreenAnnotationLinkI
+from omero.model import PlateAnnotationLinkI, WellAnnotationLinkI
+from omero.model import RoiI, PointI, LineI, RectangleI, EllipseI, PolygonI
+from omero.model import PolylineI, LabelI, LengthI, enums
+from omero.model import ProjectDatasetLinkI, ScreenPlateLinkI, ExperimenterI
 from ome_types.model import TagAnnotation, MapAnnotation, FileAnnotation, ROI
 from ome_types.model import CommentAnnotation, LongAnnotation
 from ome_types.model import TimestampAnnotation, Annotation
 from ome_types.model import Line, Point, Rectangle, Ellipse, Polygon, Shape
 from ome_types.model import Polyline, Label, Project, Screen, Dataset, OME
 from ome_types.model import Image, Plate, XMLAnnotation, AnnotationRef
+from ome_types.model import StructuredAnnotations
 from ome_types.model.simple_types import Marker
 from omero.gateway import TagAnnotationWrapper, MapAnnotationWrapper
 from omero.gateway import CommentAnnotationWrapper, LongAnnotationWrapper
@@ -21,12 +30,12 @@ from omero.gateway import FileAnnotationWrapper, OriginalFileWrapper
 from omero.gateway import TimestampAnnotationWrapper
 from omero.sys import Parameters
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, RStringI, rint
+from omero.rtypes import rstring, RStringI, rint, rlong, rlist, rdouble
+from omero.rtypes import unwrap
 from ezomero import rois
 from pathlib import Path
 import xml.etree.cElementTree as ETree
 import os
-import copy
 import re
 
 import logging
@@ -35,141 +44,308 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# number of objects sent to the update service per saveArray call
+SAVE_BATCH_SIZE = 1000
 
-def create_or_set_projects(pjs: List[Project], conn: BlitzGateway,
-                           merge: bool) -> dict:
-    pj_map = {}
-    if not merge:
-        pj_map = create_projects(pjs, conn)
-    else:
-        for pj in pjs:
-            pj_id = find_project(pj, conn)
-            if not pj_id:
-                pj_id = ezomero.post_project(conn, pj.name, pj.description)
-            pj_map[pj.id] = pj_id
-    return pj_map
+# plate paths matched per query when they are not in the import results
+PATH_QUERY_BATCH_SIZE = 100
 
+# ROIs (with all their shapes) saved per saveArray call in create_rois
+ROI_BATCH_SIZE = 500
 
-def create_projects(pjs: List[Project], conn: BlitzGateway) -> dict:
-    pj_map = {}
-    for pj in pjs:
-        pj_id = ezomero.post_project(conn, pj.name, pj.description)
-        pj_map[pj.id] = pj_id
-    return pj_map
+# OMERO model classes of the annotations created by create_annotations;
+# provenance XMLAnnotations are created as MapAnnotations
+ANNOTATION_CLASSES = {
+    TagAnnotation: TagAnnotationI,
+    MapAnnotation: MapAnnotationI,
+    CommentAnnotation: CommentAnnotationI,
+    TimestampAnnotation: TimestampAnnotationI,
+    LongAnnotation: LongAnnotationI,
+    FileAnnotation: FileAnnotationI,
+    XMLAnnotation: MapAnnotationI,
+}
 
 
-def find_project(pj: Project, conn: BlitzGateway) -> int:
-    id = 0
-    my_exp_id = conn.getUser().getId()
-    for p in conn.getObjects("Project", opts={'owner': my_exp_id}):
-        if p.getName() == pj.name:
-            id = p.getId()
-    return id
+class MergeIndex:
+    """
+    Name index of the Projects, Screens and Datasets owned by the current
+    user, used to find existing containers when merging. Each kind is
+    loaded with a single projection query the first time it is needed;
+    containers created during the unpack are added with `add`.
+    """
 
+    QUERIES = {
+        "Project": "SELECT p.id, p.name FROM Project p"
+                   " WHERE p.details.owner.id = :owner ORDER BY p.id",
+        "Screen": "SELECT s.id, s.name FROM Screen s"
+                  " WHERE s.details.owner.id = :owner ORDER BY s.id",
+        # datasets are keyed by the name of their parent project, or None
+        # for orphaned datasets
+        "Dataset": "SELECT d.id, d.name, p.name FROM Dataset d"
+                   " LEFT OUTER JOIN d.projectLinks l"
+                   " LEFT OUTER JOIN l.parent p"
+                   " WHERE (l.id IS NULL AND d.details.owner.id = :owner)"
+                   " OR p.details.owner.id = :owner ORDER BY d.id",
+    }
 
-def create_or_set_screens(scrs: List[Screen], conn: BlitzGateway, merge: bool
-                          ) -> dict:
-    scr_map = {}
-    if not merge:
-        scr_map = create_screens(scrs, conn)
-    else:
-        for scr in scrs:
-            scr_id = find_screen(scr, conn)
-            if not scr_id:
-                scr_id = ezomero.post_screen(conn, scr.name, scr.description)
-            scr_map[scr.id] = scr_id
-    return scr_map
+    def __init__(self, conn: BlitzGateway):
+        self.conn = conn
+        self.owner_id = conn.getUser().getId()
+        self._names = {}
 
+    def _load(self, kind: str) -> dict:
+        if kind not in self._names:
+            params = Parameters()
+            params.map = {"owner": rlong(self.owner_id)}
+            results = self.conn.getQueryService().projection(
+                self.QUERIES[kind], params, self.conn.SERVICE_OPTS)
+            names = {}
+            for r in results:
+                parent = None
+                if len(r) > 2 and r[2] is not None:
+                    parent = r[2].val
+                # same as the name scans this replaces: the last match wins
+                names[(parent, r[1].val)] = r[0].val
+            self._names[kind] = names
+        return self._names[kind]
 
-def create_screens(scrs: List[Screen], conn: BlitzGateway) -> dict:
-    scr_map = {}
-    for scr in scrs:
-        scr_id = ezomero.post_screen(conn, scr.name, scr.description)
-        scr_map[scr.id] = scr_id
-    return scr_map
+    def find(self, kind: str, name: str, parent: Union[str, None] = None
+             ) -> int:
+        return self._load(kind).get((parent, name), 0)
 
+    def add(self, kind: str, name: str, id: int,
+            parent: Union[str, None] = None):
+        self._load(kind)[(parent, name)] = id
 
-def find_screen(sc: Screen, conn: BlitzGateway) -> int:
-    id = 0
-    my_exp_id = conn.getUser().getId()
-    for s in conn.getObjects("Screen", opts={'owner': my_exp_id}):
-        if s.getName() == sc.name:
-            id = s.getId()
-    return id
+
+def create_or_set_containers(ome: OME, conn: BlitzGateway, merge: bool,
+                             index: Union[MergeIndex, None] = None,
+                             batch_size: int = SAVE_BATCH_SIZE
+                             ) -> Tuple[dict, dict, dict]:
+    """
+    Creates the Projects, Datasets and Screens of `ome` (or, when merging,
+    finds existing ones by name) and returns the project, dataset and screen
+    maps from source to destination IDs. All new containers are saved
+    together with saveAndReturnArray.
+    """
+    if merge and index is None:
+        index = MergeIndex(conn)
+    maps = {"Project": {}, "Dataset": {}, "Screen": {}}
+    # (kind, container, names of the projects it will be linked to, whether
+    # it may reuse a container created earlier in this unpack with the same
+    # name)
+    missing = []
+    for pj in ome.projects:
+        pj_id = find_project(pj, index) if merge else 0
+        if pj_id:
+            maps["Project"][pj.id] = pj_id
+        else:
+            missing.append(("Project", pj, [], merge))
+    parents = {}
+    for pj in ome.projects:
+        for dsref in pj.dataset_refs:
+            parents.setdefault(dsref.id, []).append(pj.name)
+    for ds in ome.datasets:
+        pj_names = parents.get(ds.id, [])
+        ds_id = find_dataset(ds, pj_names, index) if merge else 0
+        if ds_id:
+            maps["Dataset"][ds.id] = ds_id
+        else:
+            # new datasets are orphans until link_datasets runs, so only
+            # orphaned ones can match them
+            missing.append(("Dataset", ds, pj_names, merge and not pj_names))
+    for scr in ome.screens:
+        scr_id = find_screen(scr, index) if merge else 0
+        if scr_id:
+            maps["Screen"][scr.id] = scr_id
+        else:
+            missing.append(("Screen", scr, [], merge))
+
+    new_objs = []
+    new_containers = []
+    created = {}
+    for kind, obj, pj_names, reuse in missing:
+        if reuse and (kind, obj.name) in created:
+            new_containers[created[(kind, obj.name)]][3].append(obj.id)
+            continue
+        created[(kind, obj.name)] = len(new_objs)
+        new_objs.append(create_container(kind, obj))
+        new_containers.append((kind, obj.name, pj_names, [obj.id]))
+    saved = save_and_return_batched(new_objs, conn, batch_size)
+    for (kind, name, pj_names, ids), new_obj in zip(new_containers, saved):
+        new_id = new_obj.getId().getValue()
+        for src_id in ids:
+            maps[kind][src_id] = new_id
+        if merge:
+            # keyed the way the index will see it once link_datasets has
+            # linked it to its projects
+            for parent in pj_names or [None]:
+                index.add(kind, name, new_id, parent)
+    return maps["Project"], maps["Dataset"], maps["Screen"]
 
 
-def create_or_set_datasets(dss: List[Dataset], pjs: List[Project],
-                           conn: BlitzGateway, merge: bool) -> dict:
-    ds_map = {}
-    if not merge:
-        ds_map = create_datasets(dss, conn)
+def create_container(kind: str, obj: Union[Project, Dataset, Screen]
+                     ) -> IObject:
+    if kind == "Project":
+        container = ProjectI()
+    elif kind == "Dataset":
+        container = DatasetI()
     else:
-        for ds in dss:
-            ds_id = find_dataset(ds, pjs, conn)
-            if not ds_id:
-                dataset = DatasetWrapper(conn, DatasetI())
-                dataset.setName(ds.name)
-                if ds.description is not None:
-                    dataset.setDescription(ds.description)
-                dataset.save()
-                ds_id = dataset.getId()
-            ds_map[ds.id] = ds_id
-    return ds_map
-
-
-def create_datasets(dss: List[Dataset], conn: BlitzGateway) -> dict:
-    """
-    Currently doing it the non-ezomero way because ezomero always
-    puts "orphan" Datasets in the user's default group
-    """
-    ds_map = {}
-    for ds in dss:
-        dataset = DatasetWrapper(conn, DatasetI())
-        dataset.setName(ds.name)
-        if ds.description is not None:
-            dataset.setDescription(ds.description)
-        dataset.save()
-        ds_id = dataset.getId()
-        ds_map[ds.id] = ds_id
-    return ds_map
-
-
-def find_dataset(ds: Dataset, pjs: List[Project], conn: BlitzGateway) -> int:
+        container = ScreenI()
+    container.setName(rstring(obj.name))
+    if obj.description is not None:
+        container.setDescription(rstring(obj.description))
+    return container
+
+
+def find_project(pj: Project, index: MergeIndex) -> int:
+    return index.find("Project", pj.name)
+
+
+def find_screen(sc: Screen, index: MergeIndex) -> int:
+    return index.find("Screen", sc.name)
+
+
+def find_dataset(ds: Dataset, pj_names: List[str], index: MergeIndex) -> int:
+    """
+    Finds a Dataset named like `ds` in one of the projects named in
+    `pj_names` (the pack projects containing it), or among orphaned
+    Datasets if there are none.
+    """
     id = 0
-    my_exp_id = conn.getUser().getId()
-    orphan = True
-    for pj in pjs:
-        for dsref in pj.dataset_refs:
-            if dsref.id == ds.id:
-                orphan = False
-    if not orphan:
-        for pj in pjs:
-            for p in conn.getObjects("Project", opts={'owner': my_exp_id}):
-                if p.getName() == pj.name:
-                    for dsref in pj.dataset_refs:
-                        if dsref.id == ds.id:
-                            for ds_rem in p.listChildren():
-                                if ds.name == ds_rem.getName():
-                                    id = ds_rem.getId()
+    if pj_names:
+        for pj_name in pj_names:
+            id = index.find("Dataset", ds.name, pj_name) or id
     else:
-        for d in conn.getObjects("Dataset", opts={'owner': my_exp_id,
-                                                  'orphaned': True}):
-            if d.getName() == ds.name:
-                id = d.getId()
+        id = index.find("Dataset", ds.name)
     return id
 
 
+def parse_transfer_xml(ann: XMLAnnotation
+                       ) -> Tuple[Set[str], Union[str, None]]:
+    # Returns the top-level element names of an XMLAnnotation (e.g.
+    # CLITransferServerPath, CLITransferMetadata) and its server path, if any
+    tags = set()
+    fpath = None
+    tree = ETree.fromstring(to_xml(ann.value, canonicalize=True))
+    for el in tree:
+        tag = el.tag.rpartition('}')[2]
+        tags.add(tag)
+        if tag == "CLITransferServerPath":
+            for el2 in el:
+                if el2.tag.rpartition('}')[2] == "Path":
+                    fpath = el2.text
+    return tags, fpath
+
+
+class ServerPathIndex:
+    """
+    Index of the transfer XMLAnnotations in a list of annotations (usually
+    `ome.structured_annotations`). Each one is parsed once; server paths
+    are then looked up from annotation refs, or by object ID for the
+    objects passed to `add`.
+    """
+
+    def __init__(self, ans: List[Annotation]):
+        # annotation ID -> (position in `ans`, path), so that lookups pick
+        # the same annotation get_server_path would
+        self._paths = {}
+        self._tags = {}
+        self._objects = {}
+        for pos, an in enumerate(ans):
+            if isinstance(an, XMLAnnotation):
+                tags, fpath = parse_transfer_xml(an)
+                self._tags[an.id] = tags
+                if fpath:
+                    self._paths[an.id] = (pos, fpath)
+
+    @classmethod
+    def from_ome(cls, ome: OME) -> "ServerPathIndex":
+        index = cls(ome.structured_annotations)
+        for obj in ome.images + ome.plates:
+            index.add(obj)
+        for an in ome.structured_annotations:
+            if isinstance(an, FileAnnotation):
+                index.add(an)
+        return index
+
+    def add(self, obj: Union[Image, Plate, Annotation]):
+        self._objects[obj.id] = self.get(obj.annotation_refs)
+
+    def get(self, anrefs: List[AnnotationRef]) -> Union[str, None]:
+        found = [self._paths[ref.id] for ref in anrefs
+                 if ref.id in self._paths]
+        if not found:
+            return None
+        return min(found)[1]
+
+    def object_path(self, obj_id: str) -> Union[str, None]:
+        return self._objects.get(obj_id)
+
+    def is_xml(self, ann_id: str) -> bool:
+        return ann_id in self._tags
+
+    def is_server_path(self, ann_id: str) -> bool:
+        return "CLITransferServerPath" in self._tags.get(ann_id, ())
+
+    def is_metadata(self, ann_id: str) -> bool:
+        return "CLITransferMetadata" in self._tags.get(ann_id, ())
+
+
+def _server_path(ann: Annotation, ans: List[Annotation],
+                 index: Union[ServerPathIndex, None]) -> Union[str, None]:
+    if index is None:
+        return get_server_path(ann.annotation_refs, ans)
+    return index.get(ann.annotation_refs)
+
+
+def save_and_return_batched(objs: List[IObject], conn: BlitzGateway,
+                            batch_size: int = SAVE_BATCH_SIZE
+                            ) -> List[IObject]:
+    """
+    Saves `objs` with saveAndReturnArray, `batch_size` objects per call.
+    The saved objects are returned in the same order as `objs`.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    update_service = conn.getUpdateService()
+    saved = []
+    for start in range(0, len(objs), batch_size):
+        saved.extend(update_service.saveAndReturnArray(
+            objs[start:start + batch_size], conn.SERVICE_OPTS))
+    return saved
+
+
+def save_batched(objs: List[IObject], conn: BlitzGateway,
+                 batch_size: int = SAVE_BATCH_SIZE):
+    """
+    Saves `objs` with saveArray, `batch_size` objects per call.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    update_service = conn.getUpdateService()
+    for start in range(0, len(objs), batch_size):
+        update_service.saveArray(objs[start:start + batch_size],
+                                 conn.SERVICE_OPTS)
+
+
 def create_annotations(ans: List[Annotation], conn: BlitzGateway, hash: str,
                        folder: str, figure: bool, img_map: dict,
-                       metadata: List[str]) -> dict:
-    ann_map = {}
+                       metadata: List[str],
+                       index: Union[ServerPathIndex, None] = None,
+                       batch_size: int = SAVE_BATCH_SIZE) -> dict:
+    if index is None:
+        index = ServerPathIndex(ans)
+    # annotations are built locally and saved in batches at the end
+    src_ids = []
+    new_anns = []
     for an in ans:
         if isinstance(an, TagAnnotation):
             tag_ann = TagAnnotationWrapper(conn)
             tag_ann.setValue(an.value)
             tag_ann.setDescription(an.description)
-            tag_ann.save()
-            ann_map[an.id] = tag_ann.getId()
+            src_ids.append(an.id)
+            new_anns.append(tag_ann._obj)
         elif isinstance(an, MapAnnotation):
             map_ann = MapAnnotationWrapper(conn)
             namespace = an.namespace
@@ -178,50 +354,45 @@ def create_annotations(ans: List[Annotation], conn: BlitzGateway, hash: str,
             for v in an.value.ms:
                 key_value_data.append([v.k, v.value])
             map_ann.setValue(key_value_data)
-            map_ann.save()
-            ann_map[an.id] = map_ann.getId()
+            src_ids.append(an.id)
+            new_anns.append(map_ann._obj)
         elif isinstance(an, CommentAnnotation):
             comm_ann = CommentAnnotationWrapper(conn)
             comm_ann.setValue(an.value)
             comm_ann.setDescription(an.description)
-            comm_ann.save()
-            ann_map[an.id] = comm_ann.getId()
+            src_ids.append(an.id)
+            new_anns.append(comm_ann._obj)
         elif isinstance(an, TimestampAnnotation):
             ts_ann = TimestampAnnotationWrapper(conn)
             ts_ann.setValue(an.value)
             ts_ann.setDescription(an.description)
             ts_ann.setNs(an.namespace)
-            ts_ann.save()
-            ann_map[an.id] = ts_ann.getId()
+            src_ids.append(an.id)
+            new_anns.append(ts_ann._obj)
         elif isinstance(an, LongAnnotation):
             comm_ann = LongAnnotationWrapper(conn)
             comm_ann.setValue(an.value)
             comm_ann.setDescription(an.description)
             comm_ann.setNs(an.namespace)
-            comm_ann.save()
-            ann_map[an.id] = comm_ann.getId()
+            src_ids.append(an.id)
+            new_anns.append(comm_ann._obj)
         elif isinstance(an, FileAnnotation):
             if an.namespace == "omero.web.figure.json":
                 if not figure:
                     continue
                 else:
-                    update_figure_refs(an, ans, img_map, folder)
-            original_file = create_original_file(an, ans, conn, folder)
+                    update_figure_refs(an, ans, img_map, folder, index)
+            original_file = create_original_file(an, ans, conn, folder,
+                                                 index)
             file_ann = FileAnnotationWrapper(conn)
             file_ann.setDescription(an.description)
             file_ann.setNs(an.namespace)
             file_ann.setFile(original_file)
-            file_ann.save()
-            ann_map[an.id] = file_ann.getId()
+            src_ids.append(an.id)
+            new_anns.append(file_ann._obj)
         elif isinstance(an, XMLAnnotation):
             # pass if path, use if provenance metadata
-            tree = ETree.fromstring(to_xml(an.value,
-                                           canonicalize=True))
-            is_metadata = False
-            for el in tree:
-                if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-                    is_metadata = True
-            if is_metadata:
+            if index.is_metadata(an.id):
                 map_ann = MapAnnotationWrapper(conn)
                 namespace = an.namespace
                 map_ann.setNs(namespace)
@@ -231,8 +402,12 @@ def create_annotations(ans: List[Annotation], conn: BlitzGateway, hash: str,
                 else:
                     key_value_data = parse_xml_metadata(an, metadata, hash)
                 map_ann.setValue(key_value_data)
-                map_ann.save()
-                ann_map[an.id] = map_ann.getId()
+                src_ids.append(an.id)
+                new_anns.append(map_ann._obj)
+    saved = save_and_return_batched(new_anns, conn, batch_size)
+    ann_map = {}
+    for src_id, obj in zip(src_ids, saved):
+        ann_map[src_id] = obj.getId().getValue()
     return ann_map
 
 
@@ -271,32 +446,20 @@ def parse_xml_metadata(ann: XMLAnnotation,
 
 def get_server_path(anrefs: List[AnnotationRef],
                     ans: List[Annotation]) -> Union[str, None]:
-    fpath = None
-    xml_ids = []
-    for an in anrefs:
-        for an_loop in ans:
-            if an.id == an_loop.id:
-                if isinstance(an_loop, XMLAnnotation):
-                    xml_ids.append(an_loop.id)
-                else:
-                    continue
+    xml_ids = set(an.id for an in anrefs)
     for an_loop in ans:
-        if an_loop.id in xml_ids:
-            if not fpath:
-                tree = ETree.fromstring(to_xml(an_loop.value,
-                                               canonicalize=True))
-                for el in tree:
-                    if el.tag.rpartition('}')[2] == "CLITransferServerPath":
-                        for el2 in el:
-                            if el2.tag.rpartition('}')[2] == "Path":
-                                fpath = el2.text
-    return fpath
+        if an_loop.id in xml_ids and isinstance(an_loop, XMLAnnotation):
+            _, fpath = parse_transfer_xml(an_loop)
+            if fpath:
+                return fpath
+    return None
 
 
 def update_figure_refs(ann: FileAnnotation, ans: List[Annotation],
-                       img_map: dict, folder: str):
+                       img_map: dict, folder: str,
+                       index: Union[ServerPathIndex, None] = None):
     curr_folder = str(Path('.').resolve())
-    fpath = get_server_path(ann.annotation_refs, ans)
+    fpath = _server_path(ann, ans, index)
     if fpath:
         dest_path = str(os.path.join(curr_folder, folder,  '.', fpath))
         with open(dest_path, 'r') as file:
@@ -317,132 +480,213 @@ def update_figure_refs(ann: FileAnnotation, ans: List[Annotation],
 
 
 def create_original_file(ann: FileAnnotation, ans: List[Annotation],
-                         conn: BlitzGateway, folder: str
+                         conn: BlitzGateway, folder: str,
+                         index: Union[ServerPathIndex, None] = None
                          ) -> OriginalFileWrapper:
     curr_folder = str(Path('.').resolve())
-    fpath = get_server_path(ann.annotation_refs, ans)
+    fpath = _server_path(ann, ans, index)
     dest_path = str(os.path.join(curr_folder, folder,  '.', fpath))
     ofile = conn.createOriginalFileFromLocalFile(dest_path)
     return ofile
 
 
-def create_plate_map(ome: OME, img_map: dict, conn: BlitzGateway
+def create_plate_map(ome: OME, img_map: dict, conn: BlitzGateway,
+                     index: Union[ServerPathIndex, None] = None,
+                     plate_paths: Union[dict, None] = None
                      ) -> Tuple[dict, OME]:
-    newome = copy.deepcopy(ome)
-    plate_map = {}
-    map_ref_ids = []
-    for plate in newome.plates:
-        ann_ids = [i.id for i in plate.annotation_refs]
-        for ann in newome.structured_annotations:
-            if (ann.id in ann_ids and
-                    isinstance(ann, XMLAnnotation)):
-                tree = ETree.fromstring(to_xml(ann.value,
-                                               canonicalize=True))
-                is_metadata = False
-                for el in tree:
-                    if el.tag.rpartition('}')[2] == "CLITransferMetadata":
-                        is_metadata = True
-                if not is_metadata:
-                    newome.structured_annotations.remove(ann)
-                    map_ref_ids.append(ann.id)
-                    file_path = get_server_path(plate.annotation_refs,
-                                                ome.structured_annotations)
-                    annref = next(filter(lambda x: x.id == ann.id,
-                                         plate.annotation_refs))
-                    newplate = next(filter(lambda x: x.id == plate.id,
-                                           newome.plates))
-                    newplate.annotation_refs.remove(annref)
-        q = conn.getQueryService()
-        params = Parameters()
+    """
+    Maps pack plates to destination plates and returns the map together
+    with a shallow copy of `ome` without the plates' path annotations.
+    Destination plates come from `plate_paths` (imported path -> plate IDs,
+    from the import output) and, for paths it does not cover, from one
+    batched query on the imported file paths.
+    """
+    if index is None:
+        index = ServerPathIndex(ome.structured_annotations)
+    if plate_paths is None:
+        plate_paths = {}
+    map_ref_ids = set()
+    file_paths = {}
+    for plate in ome.plates:
+        map_ref_ids.update(ref.id for ref in plate.annotation_refs
+                           if index.is_xml(ref.id) and
+                           not index.is_metadata(ref.id))
+        file_path = index.get(plate.annotation_refs)
         if not file_path:
             raise ValueError(f"Plate ID {plate.id} does not have a \
                              XMLAnnotation with a file path!")
         path_query = str(file_path).strip('/')
         if path_query.endswith('mock_folder'):
             path_query = path_query.rstrip("mock_folder")
-        params.map = {"cpath": rstring('%%%s%%' % path_query)}
+        file_paths[plate.id] = path_query
+    missing = sorted(set(path for path in file_paths.values()
+                         if path.strip('/') not in plate_paths))
+    if missing:
+        logger.warning(f"{len(missing)} plate path(s) were not reported by "
+                       "the import; matching them on imported file paths")
+    found = find_plates_by_path(missing, conn)
+    candidates = {}
+    for plate_id, path in file_paths.items():
+        if path.strip('/') in plate_paths:
+            candidates[plate_id] = set(plate_paths[path.strip('/')])
+        else:
+            candidates[plate_id] = found.get(path, set())
+    transferred = find_transferred_plates(
+        set().union(*candidates.values()), conn)
+    plate_map = {}
+    for plate in ome.plates:
+        plate_ids = sorted(candidates[plate.id] - transferred)
+        if plate_ids:
+            # plate was imported as plate
+            plate_id = plate_ids[0]
+        else:
+            # plate was imported as images
+            plate_id = create_plate_from_images(plate, img_map, conn)
+        plate_map[plate.id] = plate_id
+    plates = []
+    for plate in ome.plates:
+        refs = [ref for ref in plate.annotation_refs
+                if ref.id not in map_ref_ids]
+        if len(refs) != len(plate.annotation_refs):
+            plate = plate.model_copy(update={"annotation_refs": refs})
+        plates.append(plate)
+    anns = StructuredAnnotations()
+    anns.extend(an for an in ome.structured_annotations
+                if an.id not in map_ref_ids)
+    newome = ome.model_copy(update={"plates": plates,
+                                    "structured_annotations": anns})
+    return plate_map, newome
+
+
+def find_plates_by_path(paths: List[str], conn: BlitzGateway,
+                        batch_size: int = PATH_QUERY_BATCH_SIZE) -> dict:
+    """
+    Returns a dict from each of `paths` to the set of IDs of the Plates
+    whose imported files have a client path containing it as whole path
+    components. Paths are matched `batch_size` at a time in a single query.
+    """
+    found = {}
+    q = conn.getQueryService()
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start:start + batch_size]
+        params = Parameters()
+        params.map = {f"cpath{i}": rstring('%%%s%%' % path)
+                      for i, path in enumerate(batch)}
+        clauses = " OR ".join(f"u.clientPath LIKE :cpath{i}"
+                              for i in range(len(batch)))
         results = q.projection(
-            "SELECT p.id FROM Plate p"
+            "SELECT DISTINCT p.id, u.clientPath FROM Plate p"
             " JOIN p.plateAcquisitions a"
             " JOIN a.wellSample w"
             " JOIN w.image i"
             " JOIN i.fileset fs"
             " JOIN fs.usedFiles u"
-            " WHERE u.clientPath LIKE :cpath",
+            f" WHERE {clauses}",
             params,
             conn.SERVICE_OPTS
             )
-        all_plate_ids = list(set(sorted([r[0].val for r in results])))
-        plate_ids = []
-        for pl_id in all_plate_ids:
-            anns = ezomero.get_map_annotation_ids(conn, "Plate", pl_id)
-            if not anns:
-                plate_ids.append(pl_id)
-            else:
-                is_annotated = False
-                for ann in anns:
-                    ann_content = conn.getObject("MapAnnotation", ann)
-                    if ann_content.getNs() == \
-                            'openmicroscopy.org/cli/transfer':
-                        is_annotated = True
-                if not is_annotated:
-                    plate_ids.append(pl_id)
-        if plate_ids:
-            # plate was imported as plate
-            plate_id = plate_ids[0]
-        else:
-            # plate was imported as images
-            plate_id = create_plate_from_images(plate, img_map, conn)
-        plate_map[plate.id] = plate_id
-    for p in newome.plates:
-        for ref in p.annotation_refs:
-            if ref.id in map_ref_ids:
-                p.annotation_refs.remove(ref)
-    return plate_map, newome
+        for r in results:
+            for path in batch:
+                if contains_path(r[1].val, path):
+                    found.setdefault(path, set()).add(r[0].val)
+    return found
 
 
-def create_plate_from_images(plate: Plate, img_map: dict, conn: BlitzGateway
-                             ) -> int:
+def contains_path(client_path: str, path: str) -> bool:
+    """
+    Whether `path` appears in `client_path` as whole path components,
+    so that `plate1` matches `/data/plate1/a.tif` but not `/data/plate10`.
+    """
+    path = path.strip('/')
+    if not path:
+        return False
+    return f"/{path}/" in f"/{client_path.strip('/')}/"
+
+
+def find_transferred_plates(plate_ids: Set[int], conn: BlitzGateway
+                            ) -> Set[int]:
+    """
+    Returns the subset of `plate_ids` already annotated by a previous
+    transfer, in one query.
+    """
+    if not plate_ids:
+        return set()
+    params = Parameters()
+    params.map = {"ids": rlist([rlong(i) for i in plate_ids]),
+                  "ns": rstring("openmicroscopy.org/cli/transfer")}
+    results = conn.getQueryService().projection(
+        "SELECT DISTINCT l.parent.id FROM PlateAnnotationLink l"
+        " WHERE l.parent.id IN (:ids) AND l.child.ns = :ns",
+        params,
+        conn.SERVICE_OPTS
+        )
+    return set(r[0].val for r in results)
+
+
+def create_plate_from_images(plate: Plate, img_map: dict, conn: BlitzGateway,
+                             batch_size: int = SAVE_BATCH_SIZE) -> int:
     plateobj = PlateI()
     plateobj.name = RStringI(plate.name)
-    plateobj = conn.getUpdateService().saveAndReturnObject(plateobj)
+    plateobj = conn.getUpdateService().saveAndReturnObject(plateobj,
+                                                           conn.SERVICE_OPTS)
     plate_id = plateobj.getId().getValue()
+    wells = []
     for well in plate.wells:
         img_ids = []
         for ws in well.well_samples:
             if ws.image_ref:
                 for imgref in ws.image_ref:
                     img_ids.append(img_map[imgref[-1]])
-        add_image_to_plate(img_ids, plate_id, well.column,
-                           well.row, conn)
+        wells.append(create_well(img_ids, plate_id, well.column, well.row))
+    failed = save_wells(wells, conn, batch_size)
+    for row, column, err in failed:
+        logger.warning(f"Could not create well at row {row}, column "
+                       f"{column} of plate {plate_id}: {err}")
     return plate_id
 
 
-def add_image_to_plate(image_ids: List[int], plate_id: int, column: int,
-                       row: int, conn: BlitzGateway) -> bool:
+def create_well(image_ids: List[int], plate_id: int, column: int,
+                row: int) -> WellI:
     """
-    Add the Images to a Plate, creating a new well at the specified column and
-    row
-    NB - This will fail if there is already a well at that point
+    Builds an unsaved Well at the specified column and row of a Plate,
+    with one WellSample per Image
     """
-    update_service = conn.getUpdateService()
-
     well = WellI()
     well.plate = PlateI(plate_id, False)
     well.column = rint(column)
     well.row = rint(row)
+    for image_id in image_ids:
+        ws = WellSampleI()
+        ws.image = ImageI(image_id, False)
+        ws.well = well
+        well.addWellSample(ws)
+    return well
 
-    try:
-        for image_id in image_ids:
-            image = conn.getObject("Image", image_id)
-            ws = WellSampleI()
-            ws.image = ImageI(image.id, False)
-            ws.well = well
-            well.addWellSample(ws)
-        update_service.saveObject(well)
-    except Exception:
-        return False
-    return True
+
+def save_wells(wells: List[WellI], conn: BlitzGateway,
+               batch_size: int = SAVE_BATCH_SIZE
+               ) -> List[Tuple[int, int, Exception]]:
+    """
+    Saves `wells` with saveArray, `batch_size` wells per call. If a batch
+    fails, its wells are saved one by one to find the failing ones; those
+    are returned as (row, column, exception) tuples.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    update_service = conn.getUpdateService()
+    failed = []
+    for start in range(0, len(wells), batch_size):
+        batch = wells[start:start + batch_size]
+        try:
+            update_service.saveArray(batch, conn.SERVICE_OPTS)
+        except Exception:
+            for well in batch:
+                try:
+                    update_service.saveObject(well, conn.SERVICE_OPTS)
+                except Exception as err:
+                    failed.append((unwrap(well.row), unwrap(well.column),
+                                   err))
+    return failed
 
 
 def create_shapes(roi: ROI) -> List[Shape]:
@@ -533,48 +777,180 @@ def _int_to_rgba(omero_val: int) -> Tuple[int, int, int, int]:
     return (r, g, b, a)
 
 
+# _rgba_to_int and create_omero_shape follow ezomero's private
+# _rgba_to_int and _shape_to_omero_shape (ezomero/_posts.py, ezomero 3.2.3),
+# so ROIs can be built here and saved in batches instead of one
+# ezomero.post_roi call each. Keep them in step with ezomero.
+def _rgba_to_int(color: Tuple[int, int, int, int]) -> int:
+    """ Helper function returning the color as an Integer in RGBA encoding """
+    r, g, b, a = color
+    rgba_int = (r << 24) + (g << 16) + (b << 8) + a
+    if rgba_int > (2**31 - 1):  # convert to signed 32-bit int
+        rgba_int = rgba_int - 2**32
+    return rgba_int
+
+
+def create_omero_shape(shape: Shape) -> IObject:
+    """
+    Converts an ezomero shape (as built by `create_shapes`) into an
+    unsaved OMERO shape, the same way `ezomero.post_roi` does.
+    """
+    if isinstance(shape, rois.Point):
+        omero_shape = PointI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+    elif isinstance(shape, rois.Line):
+        omero_shape = LineI()
+        omero_shape.x1 = rdouble(shape.x1)
+        omero_shape.x2 = rdouble(shape.x2)
+        omero_shape.y1 = rdouble(shape.y1)
+        omero_shape.y2 = rdouble(shape.y2)
+        if shape.markerStart is not None:
+            omero_shape.markerStart = rstring(shape.markerStart)
+        if shape.markerEnd is not None:
+            omero_shape.markerEnd = rstring(shape.markerEnd)
+    elif isinstance(shape, rois.Rectangle):
+        omero_shape = RectangleI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+        omero_shape.width = rdouble(shape.width)
+        omero_shape.height = rdouble(shape.height)
+    elif isinstance(shape, rois.Ellipse):
+        omero_shape = EllipseI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+        omero_shape.radiusX = rdouble(shape.x_rad)
+        omero_shape.radiusY = rdouble(shape.y_rad)
+    elif isinstance(shape, (rois.Polygon, rois.Polyline)):
+        if isinstance(shape, rois.Polygon):
+            omero_shape = PolygonI()
+        else:
+            omero_shape = PolylineI()
+        omero_shape.points = rstring(" ".join(f"{x},{y}"
+                                              for x, y in shape.points))
+    elif isinstance(shape, rois.Label):
+        omero_shape = LabelI()
+        omero_shape.x = rdouble(shape.x)
+        omero_shape.y = rdouble(shape.y)
+        omero_shape.fontSize = LengthI(shape.fontSize,
+                                       enums.UnitsLength.POINT)
+    else:
+        raise TypeError("The shape passed for the roi is not a valid "
+                        "shape type")
+    if shape.z is not None:
+        omero_shape.theZ = rint(shape.z)
+    if shape.c is not None:
+        omero_shape.theC = rint(shape.c)
+    if shape.t is not None:
+        omero_shape.theT = rint(shape.t)
+    if shape.label is not None:
+        omero_shape.setTextValue(rstring(shape.label))
+    fill_color = shape.fill_color
+    if fill_color is None:
+        fill_color = (0, 0, 0, 0)
+    omero_shape.setFillColor(rint(_rgba_to_int(fill_color)))
+    stroke_color = shape.stroke_color
+    if stroke_color is None:
+        stroke_color = (255, 255, 0, 255)
+    omero_shape.setStrokeColor(rint(_rgba_to_int(stroke_color)))
+    stroke_width = shape.stroke_width
+    if stroke_width is None:
+        stroke_width = 1.0
+    omero_shape.setStrokeWidth(LengthI(stroke_width,
+                                       enums.UnitsLength.PIXEL))
+    return omero_shape
+
+
 def create_rois(rois: List[ROI], imgs: List[Image], img_map: dict,
-                conn: BlitzGateway):
+                conn: BlitzGateway, batch_size: int = ROI_BATCH_SIZE):
+    roi_index = {roi.id: roi for roi in rois}
+    new_rois = []
     for img in imgs:
         for roiref in img.roi_refs:
-            roi = next(filter(lambda x: x.id == roiref.id, rois))
-            shapes = create_shapes(roi)
+            roi = roi_index[roiref.id]
             img_id_dest = img_map[img.id]
-            ezomero.post_roi(conn, img_id_dest, shapes, name=roi.name,
-                             description=roi.description)
+            roiobj = RoiI()
+            if roi.name is not None:
+                roiobj.setName(rstring(roi.name))
+            if roi.description is not None:
+                roiobj.setDescription(rstring(roi.description))
+            for shape in create_shapes(roi):
+                roiobj.addShape(create_omero_shape(shape))
+            roiobj.setImage(ImageI(img_id_dest, False))
+            new_rois.append(roiobj)
+    save_batched(new_rois, conn, batch_size)
     return
 
 
-def link_datasets(ome: OME, proj_map: dict, ds_map: dict, conn: BlitzGateway):
+def get_linked_children(link_class: str, parent_ids: List[int],
+                        conn: BlitzGateway) -> Set[Tuple[int, int]]:
+    """
+    Returns the (parent ID, child ID) pairs of the existing `link_class`
+    links (e.g. ProjectDatasetLink) of the given parents, in one query.
+    """
+    if not parent_ids:
+        return set()
+    params = Parameters()
+    params.map = {"ids": rlist([rlong(i) for i in set(parent_ids)])}
+    results = conn.getQueryService().projection(
+        f"SELECT l.parent.id, l.child.id FROM {link_class} l"
+        " WHERE l.parent.id IN (:ids)",
+        params,
+        conn.SERVICE_OPTS
+        )
+    return set((r[0].val, r[1].val) for r in results)
+
+
+def _current_user_id(conn: BlitzGateway) -> int:
+    user_id = conn.SERVICE_OPTS.getOmeroUser()
+    if user_id is None:
+        user_id = conn.getUserId()
+    return int(user_id)
+
+
+def link_datasets(ome: OME, proj_map: dict, ds_map: dict, conn: BlitzGateway,
+                  batch_size: int = SAVE_BATCH_SIZE):
+    linked = get_linked_children("ProjectDatasetLink",
+                                 [proj_map[proj.id] for proj in ome.projects],
+                                 conn)
+    user_id = _current_user_id(conn)
+    links = []
     for proj in ome.projects:
         proj_id = proj_map[proj.id]
-        proj_obj = conn.getObject("Project", proj_id)
-        existing_ds = []
-        for dataset in proj_obj.listChildren():
-            existing_ds.append(dataset.getId())
-        ds_ids = []
         for ds in proj.dataset_refs:
             ds_id = ds_map[ds.id]
-            if ds_id not in existing_ds:
-                ds_ids.append(ds_id)
-        ezomero.link_datasets_to_project(conn, ds_ids, proj_id)
+            if (proj_id, ds_id) in linked:
+                continue
+            linked.add((proj_id, ds_id))
+            link = ProjectDatasetLinkI()
+            link.setParent(ProjectI(proj_id, False))
+            link.setChild(DatasetI(ds_id, False))
+            link.details.owner = ExperimenterI(user_id, False)
+            links.append(link)
+    save_batched(links, conn, batch_size)
     return
 
 
 def link_plates(ome: OME, screen_map: dict, plate_map: dict,
-                conn: BlitzGateway):
+                conn: BlitzGateway, batch_size: int = SAVE_BATCH_SIZE):
+    linked = get_linked_children("ScreenPlateLink",
+                                 [screen_map[scr.id] for scr in ome.screens],
+                                 conn)
+    user_id = _current_user_id(conn)
+    links = []
     for screen in ome.screens:
         screen_id = screen_map[screen.id]
-        scr_obj = conn.getObject("Screen", screen_id)
-        existing_pl = []
-        for pl in scr_obj.listChildren():
-            existing_pl.append(pl.getId())
-        pl_ids = []
         for pl in screen.plate_refs:
             pl_id = plate_map[pl.id]
-            if pl_id not in existing_pl:
-                pl_ids.append(pl_id)
-        ezomero.link_plates_to_screen(conn, pl_ids, screen_id)
+            if (screen_id, pl_id) in linked:
+                continue
+            linked.add((screen_id, pl_id))
+            link = ScreenPlateLinkI()
+            link.setParent(ScreenI(screen_id, False))
+            link.setChild(PlateI(pl_id, False))
+            link.details.owner = ExperimenterI(user_id, False)
+            links.append(link)
+    save_batched(links, conn, batch_size)
     return
 
 
@@ -594,117 +970,151 @@ def link_images(ome: OME, ds_map: dict, img_map: dict, conn: BlitzGateway):
 
 def link_annotations(ome: OME, proj_map: dict, ds_map: dict, img_map: dict,
                      ann_map: dict, scr_map: dict, pl_map: dict,
-                     conn: BlitzGateway):
+                     conn: BlitzGateway, batch_size: int = SAVE_BATCH_SIZE):
+    targets = []
     for proj in ome.projects:
-        proj_id = proj_map[proj.id]
-        proj_obj = conn.getObject("Project", proj_id)
-        anns = ome.structured_annotations
-        for annref in proj.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(proj_obj, ann, ann_map, conn)
+        targets.append((ProjectAnnotationLinkI,
+                        ProjectI(proj_map[proj.id], False),
+                        proj.annotation_refs))
     for ds in ome.datasets:
-        ds_id = ds_map[ds.id]
-        ds_obj = conn.getObject("Dataset", ds_id)
-        anns = ome.structured_annotations
-        for annref in ds.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(ds_obj, ann, ann_map, conn)
+        targets.append((DatasetAnnotationLinkI,
+                        DatasetI(ds_map[ds.id], False),
+                        ds.annotation_refs))
     for img in ome.images:
-        try:
-            img_id = img_map[img.id]
-            img_obj = conn.getObject("Image", img_id)
-            anns = ome.structured_annotations
-            for annref in img.annotation_refs:
-                ann = next(filter(lambda x: x.id == annref.id, anns))
-                link_one_annotation(img_obj, ann, ann_map, conn)
-        except KeyError:
-            continue
+        if img.id in img_map:
+            targets.append((ImageAnnotationLinkI,
+                            ImageI(img_map[img.id], False),
+                            img.annotation_refs))
     for scr in ome.screens:
-        scr_id = scr_map[scr.id]
-        scr_obj = conn.getObject("Screen", scr_id)
-        anns = ome.structured_annotations
-        for annref in scr.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(scr_obj, ann, ann_map, conn)
+        targets.append((ScreenAnnotationLinkI,
+                        ScreenI(scr_map[scr.id], False),
+                        scr.annotation_refs))
+    annotated_wells = []
     for pl in ome.plates:
         pl_id = pl_map[pl.id]
-        pl_obj = conn.getObject("Plate", pl_id)
-        anns = ome.structured_annotations
-        for annref in pl.annotation_refs:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            link_one_annotation(pl_obj, ann, ann_map, conn)
-        anns = ome.structured_annotations
+        targets.append((PlateAnnotationLinkI, PlateI(pl_id, False),
+                        pl.annotation_refs))
         for well in pl.wells:
             if len(well.annotation_refs) > 0:
-                row, col = well.row, well.column
-                well_id = ezomero.get_well_id(conn, pl_id, row, col)
-                well_obj = conn.getObject("Well", well_id)
-                for annref in well.annotation_refs:
-                    ann = next(filter(lambda x: x.id == annref.id, anns))
-                    link_one_annotation(well_obj, ann, ann_map, conn)
+                annotated_wells.append((pl_id, well))
+    if annotated_wells:
+        well_ids = get_well_ids(set(pl_id for pl_id, _ in annotated_wells),
+                                conn)
+        for pl_id, well in annotated_wells:
+            well_id = well_ids.get((pl_id, well.row, well.column))
+            if well_id is not None:
+                targets.append((WellAnnotationLinkI, WellI(well_id, False),
+                                well.annotation_refs))
+
+    anns = {ann.id: ann for ann in ome.structured_annotations}
+    links = []
+    linked = set()
+    for link_class, parent, annrefs in targets:
+        for annref in annrefs:
+            ann = anns.get(annref.id)
+            if ann is None or ann.id not in ann_map:
+                continue
+            ann_class = ANNOTATION_CLASSES.get(type(ann))
+            ann_id = ann_map[ann.id]
+            key = (link_class, parent.getId().getValue(), ann_id)
+            if ann_class is None or key in linked:
+                continue
+            linked.add(key)
+            link = link_class()
+            link.setParent(parent)
+            link.setChild(ann_class(ann_id, False))
+            links.append(link)
+    save_batched(links, conn, batch_size)
     return
 
 
-def link_one_annotation(obj: IObject, ann: Annotation, ann_map: dict,
-                        conn: BlitzGateway):
-    ann_id = ann_map[ann.id]
-    if isinstance(ann, TagAnnotation):
-        ann_obj = conn.getObject("TagAnnotation", ann_id)
-    elif isinstance(ann, MapAnnotation):
-        ann_obj = conn.getObject("MapAnnotation", ann_id)
-    elif isinstance(ann, CommentAnnotation):
-        ann_obj = conn.getObject("CommentAnnotation", ann_id)
-    elif isinstance(ann, TimestampAnnotation):
-        ann_obj = conn.getObject("TimestampAnnotation", ann_id)
-    elif isinstance(ann, LongAnnotation):
-        ann_obj = conn.getObject("LongAnnotation", ann_id)
-    elif isinstance(ann, FileAnnotation):
-        ann_obj = conn.getObject("FileAnnotation", ann_id)
-    elif isinstance(ann, XMLAnnotation):
-        ann_obj = conn.getObject("MapAnnotation", ann_id)
-    else:
-        ann_obj = None
-    if ann_obj:
-        obj.linkAnnotation(ann_obj)
+def get_well_ids(plate_ids: Set[int], conn: BlitzGateway) -> dict:
+    """
+    Returns a dict from (plate ID, row, column) to well ID for all wells
+    of the given plates, using a single query.
+    """
+    params = Parameters()
+    params.map = {"ids": rlist([rlong(i) for i in plate_ids])}
+    results = conn.getQueryService().projection(
+        "SELECT w.plate.id, w.row, w.column, w.id FROM Well w"
+        " WHERE w.plate.id IN (:ids)",
+        params,
+        conn.SERVICE_OPTS
+        )
+    return {(r[0].val, r[1].val, r[2].val): r[3].val for r in results}
 
 
-def rename_images(imgs: List[Image], img_map: dict, conn: BlitzGateway):
+def rename_images(imgs: List[Image], img_map: dict, conn: BlitzGateway,
+                  batch_size: int = SAVE_BATCH_SIZE):
+    names = {}
     for img in imgs:
         try:
-            img_id = img_map[img.id]
-            im_obj = conn.getObject("Image", img_id)
-            im_obj.setName(img.name)
-            im_obj.save()
+            names[img_map[img.id]] = img.name
         except KeyError:
             logger.info(f"Image corresponding to {img.id} not"
                         " found. Skipping.")
+    rename_objects("Image", names, conn, batch_size)
     return
 
 
-def rename_plates(pls: List[Plate], pl_map: dict, conn: BlitzGateway):
+def rename_plates(pls: List[Plate], pl_map: dict, conn: BlitzGateway,
+                  batch_size: int = SAVE_BATCH_SIZE):
+    names = {}
     for pl in pls:
         try:
-            pl_id = pl_map[pl.id]
-            pl_obj = conn.getObject("Plate", pl_id)
-            pl_obj.setName(pl.name)
-            pl_obj.save()
+            names[pl_map[pl.id]] = pl.name
         except KeyError:
             logger.warning(f"Plate corresponding to {pl.id} not found. "
                            "Skipping.")
+    rename_objects("Plate", names, conn, batch_size)
+    return
+
+
+def rename_objects(obj_type: str, names: dict, conn: BlitzGateway,
+                   batch_size: int = SAVE_BATCH_SIZE):
+    """
+    Sets the names in `names` (destination ID -> name) on objects of
+    `obj_type`. Objects are loaded with one query per batch and only the
+    ones whose name differs are saved, with saveArray.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    ids = list(names)
+    query_service = conn.getQueryService()
+    update_service = conn.getUpdateService()
+    for start in range(0, len(ids), batch_size):
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(i)
+                                    for i in ids[start:start + batch_size]])}
+        objs = query_service.findAllByQuery(
+            f"SELECT o FROM {obj_type} o WHERE o.id IN (:ids)",
+            params,
+            conn.SERVICE_OPTS
+            )
+        changed = []
+        for obj in objs:
+            name = names[obj.getId().getValue()]
+            if unwrap(obj.getName()) != name:
+                obj.setName(rstring(name))
+                changed.append(obj)
+        if changed:
+            update_service.saveArray(changed, conn.SERVICE_OPTS)
     return
 
 
 def populate_omero(ome: OME, img_map: dict, conn: BlitzGateway, hash: str,
                    folder: str, metadata: List[str], merge: bool,
-                   figure: bool):
-    plate_map, ome = create_plate_map(ome, img_map, conn)
+                   figure: bool, index: Union[ServerPathIndex, None] = None,
+                   plate_paths: Union[dict, None] = None):
+    if index is None:
+        index = ServerPathIndex(ome.structured_annotations)
+    plate_map, ome = create_plate_map(ome, img_map, conn, index, plate_paths)
     rename_images(ome.images, img_map, conn)
     rename_plates(ome.plates, plate_map, conn)
-    proj_map = create_or_set_projects(ome.projects, conn, merge)
-    ds_map = create_or_set_datasets(ome.datasets, ome.projects, conn, merge)
-    screen_map = create_or_set_screens(ome.screens, conn, merge)
+    proj_map, ds_map, screen_map = create_or_set_containers(ome, conn, merge)
     ann_map = create_annotations(ome.structured_annotations, conn,
-                                 hash, folder, figure, img_map, metadata)
+                                 hash, folder, figure, img_map, metadata,
+                                 index)
     create_rois(ome.rois, ome.images, img_map, conn)
     link_plates(ome, screen_map, plate_map, conn)
     link_datasets(ome, proj_map, ds_map, conn)
@@ -20,22 +20,26 @@ from ome_types.model import Point, Line, Rectangle, Ellipse, Polygon
 from ome_types.model import Polyline, Label, Shape
 from ome_types.model.map import M
 from omero.sys import Parameters
-from omero.gateway import BlitzGateway
+from omero.rtypes import rlist, rlong
+from omero.gateway import BlitzGateway, BlitzObjectWrapper
+from omero.gateway import ProjectWrapper, DatasetWrapper, ImageWrapper
+from omero.gateway import ScreenWrapper, PlateWrapper, WellWrapper
+from omero.gateway import AnnotationWrapper
 from omero.model import TagAnnotationI, MapAnnotationI, FileAnnotationI
-from omero.model import CommentAnnotationI, LongAnnotationI, Fileset
+from omero.model import CommentAnnotationI, LongAnnotationI
 from omero.model import TimestampAnnotationI
 from omero.model import PointI, LineI, RectangleI, EllipseI, PolygonI
 from omero.model import PolylineI, LabelI, ImageI, RoiI, IObject
 from omero.model import DatasetI, ProjectI, ScreenI, PlateI, WellI, Annotation
 from omero.cli import CLI
-from typing import Tuple, List, Optional, Union, Any, Dict, TextIO
+from typing import Tuple, List, Optional, Union, Any, Dict, TextIO, Iterator
 from subprocess import PIPE, DEVNULL
-from generate_omero_objects import get_server_path
+from generate_omero_objects import ServerPathIndex
 import xml.etree.cElementTree as ETree
 from os import PathLike
 import importlib
-import ezomero
 import os
+import tempfile
 import csv
 import base64
 from uuid import uuid4
@@ -43,6 +47,7 @@ from datetime import datetime
 from pathlib import Path
 import shutil
 import copy
+import re
 
 import logging
 
@@ -50,6 +55,17 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+QUERY_BATCH_SIZE = 1000
+# ROIs are fetched together with all their shapes, so keep those batches
+# (in number of images per query) smaller
+ROI_QUERY_BATCH_SIZE = 100
+# wells come with their well samples, so a plate can add a few thousand
+# rows; batches are in number of plates per query
+WELL_QUERY_BATCH_SIZE = 10
+# namespace attributes to_xml adds to the root of every serialized element
+_XML_NAMESPACES = re.compile(r' xmlns="[^"]*" xmlns:xsi="[^"]*"'
+                             r' xsi:schemaLocation="[^"]*"')
+
 
 def create_proj_and_ref(**kwargs) -> Tuple[Project, ProjectRef]:
     proj = Project(**kwargs)
@@ -375,6 +391,7 @@ def create_filepath_annotations(id: str, conn: BlitzGateway,
                                 plate_path: Optional[str] = None,
                                 ds: Optional[str] = None,
                                 proj: Optional[str] = None,
+                                cache: Optional["PackCache"] = None
                                 ) -> Tuple[List[XMLAnnotation],
                                            List[AnnotationRef]]:
     ns = 'openmicroscopy.org/cli/transfer'
@@ -387,14 +404,12 @@ def create_filepath_annotations(id: str, conn: BlitzGateway,
     if not proj:
         proj = ""
     if fp_type == "Image":
-        fpaths = ezomero.get_original_filepaths(conn, clean_id)
+        if cache is None:
+            raise TypeError("A PackCache is needed for Image file paths")
+        fpaths = cache.original_filepaths(clean_id)
         if len(fpaths) > 1:
             if not simple:
-                allpaths = []
-                for f in fpaths:
-                    f = Path(f)
-                    allpaths.append(f.parts)
-                common_root = Path(*os.path.commonprefix(allpaths))
+                common_root = cache.common_root(clean_id)
             else:
                 common_root = "./"
                 common_root = Path(common_root) / proj / ds
@@ -454,20 +469,39 @@ def create_figure_annotations(id: str) -> Tuple[XMLAnnotation,
     return an, anref
 
 
+def create_provenance_context(conn: BlitzGateway) -> Dict[str, str]:
+    """
+    Values shared by every provenance annotation of a pack run; computed
+    once so that packing does not query the server again for each image.
+    """
+    software = "omero-cli-transfer"
+    return {
+        "software": software,
+        "version": importlib.metadata.version(software),
+        "date_time": datetime.now().strftime("%d/%m/%Y, %H:%M:%S"),
+        "curr_user": conn.getUser().getName(),
+        "curr_group": conn.getGroupFromContext().getName(),
+        "db_id": conn.getConfigService().getDatabaseUuid(),
+    }
+
+
 def create_provenance_metadata(conn: BlitzGateway, img_id: int,
                                hostname: str,
-                               metadata: Union[List[str], None], plate: bool
+                               metadata: Union[List[str], None], plate: bool,
+                               context: Optional[Dict[str, str]] = None
                                ) -> Union[Tuple[MapAnnotation, AnnotationRef],
                                           Tuple[None, None]]:
     if not metadata:
         return None, None
-    software = "omero-cli-transfer"
-    version = importlib.metadata.version(software)
-    date_time = datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
+    if context is None:
+        context = create_provenance_context(conn)
+    software = context["software"]
+    version = context["version"]
+    date_time = context["date_time"]
     ns = 'openmicroscopy.org/cli/transfer'
-    curr_user = conn.getUser().getName()
-    curr_group = conn.getGroupFromContext().getName()
-    db_id = conn.getConfigService().getDatabaseUuid()
+    curr_user = context["curr_user"]
+    curr_group = context["curr_group"]
+    db_id = context["db_id"]
 
     md_dict: Dict[str, Any] = {}
     if plate:
@@ -691,8 +725,386 @@ def create_empty_pixels(image, id):
     return pixels
 
 
-def populate_roi(obj: RoiI, roi_obj: IObject, ome: OME, conn: BlitzGateway
-                 ) -> Union[ROIRef, None]:
+def _batched(ids: List[int], size: int = QUERY_BATCH_SIZE
+             ) -> Iterator[List[int]]:
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _ids_params(ids: List[int]) -> Parameters:
+    params = Parameters()
+    params.map = {"ids": rlist([rlong(i) for i in ids])}
+    return params
+
+
+def find_all_by_ids(conn: BlitzGateway, query: str, ids: List[int],
+                    batch_size: int = QUERY_BATCH_SIZE) -> List[IObject]:
+    """
+    Runs `query` (which must use an `:ids` parameter) over `ids`,
+    in batches of at most `batch_size` ids per round trip.
+    """
+    q = conn.getQueryService()
+    results = []
+    for batch in _batched(ids, batch_size):
+        results.extend(q.findAllByQuery(query, _ids_params(batch),
+                                        conn.SERVICE_OPTS))
+    return results
+
+
+def find_rows_by_ids(conn: BlitzGateway, query: str, ids: List[int]
+                     ) -> List[List[Any]]:
+    """
+    Same as find_all_by_ids, for projections; returns unwrapped rows.
+    """
+    q = conn.getQueryService()
+    rows = []
+    for batch in _batched(ids):
+        for row in q.projection(query, _ids_params(batch), conn.SERVICE_OPTS):
+            rows.append([col.val if col is not None else None for col in row])
+    return rows
+
+
+def find_ids_by_ids(conn: BlitzGateway, query: str, ids: List[int]
+                    ) -> List[int]:
+    return sorted(set(row[0] for row in find_rows_by_ids(conn, query, ids)))
+
+
+def load_annotations(conn: BlitzGateway, datatype: str, ids: List[int]
+                     ) -> Dict[int, List[AnnotationWrapper]]:
+    """
+    Loads the annotations linked to all `datatype` objects in `ids` and
+    returns them indexed by parent ID. Every distinct annotation is wrapped
+    once and shared between all the parents it is linked to.
+    """
+    index: Dict[int, List[AnnotationWrapper]] = {i: [] for i in ids}
+    query = (f"SELECT l FROM {datatype}AnnotationLink l"
+             " JOIN FETCH l.child"
+             " WHERE l.parent.id IN (:ids)"
+             " ORDER BY l.id")
+    links = find_all_by_ids(conn, query, ids)
+    file_ids = [link.getChild().getId().getValue() for link in links
+                if isinstance(link.getChild(), FileAnnotationI)]
+    query = ("SELECT a FROM FileAnnotation a"
+             " JOIN FETCH a.file"
+             " WHERE a.id IN (:ids)")
+    files = {}
+    for ann in find_all_by_ids(conn, query, file_ids):
+        files[ann.getId().getValue()] = ann
+    wrapped: Dict[int, AnnotationWrapper] = {}
+    for link in links:
+        ann_id = link.getChild().getId().getValue()
+        if ann_id not in wrapped:
+            ann = files.get(ann_id, link.getChild())
+            wrapped[ann_id] = AnnotationWrapper._wrap(conn, ann, link=link)
+        index[link.getParent().getId().getValue()].append(wrapped[ann_id])
+    return index
+
+
+class PackCache:
+    """
+    Server objects prefetched for a single pack run.
+
+    The Project/Dataset/Image and Screen/Plate/Well/Image hierarchies
+    (including Pixels, Filesets and WellSamples) are loaded with a handful
+    of fetch-join queries, so that the populate_* functions can walk them
+    in memory instead of calling back to the server for every node. ROIs
+    (with their shapes) and annotations of all prefetched objects are
+    loaded in bulk and indexed by parent. Anything that was not prefetched
+    is loaded on demand, with the same queries.
+    """
+
+    CHILD_TYPES = {"Project": "Dataset", "Dataset": "Image",
+                   "Screen": "Plate", "Plate": "Well"}
+
+    def __init__(self, conn: BlitzGateway,
+                 provenance: Optional[Dict[str, str]] = None):
+        self.conn = conn
+        self.provenance = provenance
+        self.objects: Dict[Tuple[str, int], BlitzObjectWrapper] = {}
+        self.children: Dict[Tuple[str, int], List[int]] = {}
+        self.image_filesets: Dict[int, Optional[int]] = {}
+        self.fileset_images: Dict[int, List[int]] = {}
+        self.fileset_paths: Dict[int, List[str]] = {}
+        self.fileset_roots: Dict[int, Path] = {}
+        self.annotations: Dict[str, Dict[int, List[AnnotationWrapper]]] = {}
+        self.rois: Dict[int, List[RoiI]] = {}
+
+    def prefetch(self, datatype: str, ids: List[int]):
+        targets = {datatype: list(ids)}
+        self._load(datatype, ids)
+        for dtype, obj_id in self.objects:
+            targets.setdefault(dtype, []).append(obj_id)
+        targets["Roi"] = self._load_rois(targets.get("Image", []))
+        for dtype, dtype_ids in targets.items():
+            self.prefetch_annotations(dtype, dtype_ids)
+
+    def prefetch_annotations(self, datatype: str, ids: List[int]):
+        index = self.annotations.setdefault(datatype, {})
+        ids = [i for i in set(ids) if i not in index]
+        if ids:
+            index.update(load_annotations(self.conn, datatype, ids))
+
+    def _load(self, datatype: str, ids: List[int]) -> bool:
+        loaders = {"Project": self._load_projects,
+                   "Dataset": self._load_datasets,
+                   "Image": self._load_images,
+                   "Screen": self._load_screens,
+                   "Plate": self._load_plates}
+        if datatype not in loaders:
+            return False
+        loaders[datatype](ids)
+        return True
+
+    def _load_projects(self, ids: List[int]):
+        query = ("SELECT DISTINCT p FROM Project p"
+                 " LEFT OUTER JOIN FETCH p.datasetLinks l"
+                 " LEFT OUTER JOIN FETCH l.child"
+                 " WHERE p.id IN (:ids)")
+        ds_ids = []
+        for proj in find_all_by_ids(self.conn, query, ids):
+            proj_id = proj.getId().getValue()
+            children = sorted(set(link.getChild().getId().getValue()
+                                  for link in proj.copyDatasetLinks()))
+            self.objects[("Project", proj_id)] = ProjectWrapper(self.conn,
+                                                                proj)
+            self.children[("Project", proj_id)] = children
+            ds_ids.extend(children)
+        self._load_datasets(ds_ids)
+
+    def _load_datasets(self, ids: List[int]):
+        query = ("SELECT DISTINCT d FROM Dataset d"
+                 " LEFT OUTER JOIN FETCH d.imageLinks l"
+                 " LEFT OUTER JOIN FETCH l.child"
+                 " WHERE d.id IN (:ids)")
+        img_ids = []
+        for ds in find_all_by_ids(self.conn, query, ids):
+            ds_id = ds.getId().getValue()
+            children = sorted(set(link.getChild().getId().getValue()
+                                  for link in ds.copyImageLinks()))
+            self.objects[("Dataset", ds_id)] = DatasetWrapper(self.conn, ds)
+            self.children[("Dataset", ds_id)] = children
+            img_ids.extend(children)
+        self._load_images(img_ids)
+
+    def _load_screens(self, ids: List[int]):
+        query = ("SELECT DISTINCT s FROM Screen s"
+                 " LEFT OUTER JOIN FETCH s.plateLinks l"
+                 " LEFT OUTER JOIN FETCH l.child"
+                 " WHERE s.id IN (:ids)")
+        pl_ids = []
+        for scr in find_all_by_ids(self.conn, query, ids):
+            scr_id = scr.getId().getValue()
+            children = sorted(set(link.getChild().getId().getValue()
+                                  for link in scr.copyPlateLinks()))
+            self.objects[("Screen", scr_id)] = ScreenWrapper(self.conn, scr)
+            self.children[("Screen", scr_id)] = children
+            pl_ids.extend(children)
+        self._load_plates(pl_ids)
+
+    def _load_plates(self, ids: List[int]):
+        query = "SELECT p FROM Plate p WHERE p.id IN (:ids)"
+        pl_ids = []
+        for pl in find_all_by_ids(self.conn, query, ids):
+            pl_id = pl.getId().getValue()
+            self.objects[("Plate", pl_id)] = PlateWrapper(self.conn, pl)
+            self.children[("Plate", pl_id)] = []
+            pl_ids.append(pl_id)
+        # wells come with their samples and images loaded (as in
+        # PlateWrapper.listChildren), so wrapping them does not go back to
+        # the server
+        query = ("SELECT DISTINCT w FROM Well w"
+                 " LEFT OUTER JOIN FETCH w.wellSamples ws"
+                 " LEFT OUTER JOIN FETCH ws.image"
+                 " WHERE w.plate.id IN (:ids)"
+                 " ORDER BY w.id")
+        img_ids = []
+        for well in find_all_by_ids(self.conn, query, pl_ids,
+                                    WELL_QUERY_BATCH_SIZE):
+            well_id = well.getId().getValue()
+            pl_id = well.getPlate().getId().getValue()
+            self.objects[("Well", well_id)] = WellWrapper(self.conn, well)
+            self.children[("Plate", pl_id)].append(well_id)
+            img_ids.extend(ws.getImage().getId().getValue()
+                           for ws in well.copyWellSamples())
+        self._load_images(img_ids)
+
+    def _load_images(self, ids: List[int]):
+        query = ("SELECT DISTINCT i FROM Image i"
+                 " JOIN FETCH i.pixels pix"
+                 " JOIN FETCH pix.pixelsType"
+                 " JOIN FETCH pix.dimensionOrder"
+                 " LEFT OUTER JOIN FETCH i.fileset"
+                 " WHERE i.%s IN (:ids)")
+        fs_ids = []
+        for img in find_all_by_ids(self.conn, query % "id", ids):
+            self._add_image(img)
+            if img.getFileset() is not None:
+                fs_ids.append(img.getFileset().getId().getValue())
+        # also load every other image of the filesets we have seen, since
+        # populate_image packs whole filesets
+        fs_ids = [i for i in set(fs_ids) if i not in self.fileset_images]
+        for img in find_all_by_ids(self.conn, query % "fileset.id", fs_ids):
+            self._add_image(img)
+        for fs_id in fs_ids:
+            self.fileset_images.setdefault(fs_id, [])
+        for img_id, fs_id in self.image_filesets.items():
+            if fs_id in fs_ids:
+                self.fileset_images[fs_id].append(img_id)
+        for fs_id in fs_ids:
+            self.fileset_images[fs_id].sort()
+        self._load_fileset_paths(fs_ids)
+
+    def _load_fileset_paths(self, fs_ids: List[int]):
+        # same (ManagedRepository) paths as ezomero.get_original_filepaths,
+        # but for all filesets at once rather than once per image
+        query = ("SELECT f.id, o.path, o.name FROM Fileset f"
+                 " JOIN f.usedFiles fe"
+                 " JOIN fe.originalFile o"
+                 " WHERE f.id IN (:ids)")
+        fs_ids = [i for i in set(fs_ids) if i not in self.fileset_paths]
+        for fs_id in fs_ids:
+            self.fileset_paths[fs_id] = []
+        for fs_id, path, name in find_rows_by_ids(self.conn, query, fs_ids):
+            self.fileset_paths[fs_id].append(path + name)
+
+    def _load_rois(self, img_ids: List[int]) -> List[int]:
+        query = ("SELECT DISTINCT r FROM Roi r"
+                 " LEFT OUTER JOIN FETCH r.shapes"
+                 " WHERE r.image.id IN (:ids)"
+                 " ORDER BY r.id")
+        img_ids = [i for i in set(img_ids) if i not in self.rois]
+        for img_id in img_ids:
+            self.rois[img_id] = []
+        roi_ids = []
+        for roi in find_all_by_ids(self.conn, query, img_ids,
+                                   ROI_QUERY_BATCH_SIZE):
+            self.rois[roi.getImage().getId().getValue()].append(roi)
+            roi_ids.append(roi.getId().getValue())
+        return roi_ids
+
+    def _add_image(self, img: ImageI):
+        img_id = img.getId().getValue()
+        self.objects[("Image", img_id)] = ImageWrapper(self.conn, img)
+        if img.getFileset() is not None:
+            self.image_filesets[img_id] = img.getFileset().getId().getValue()
+        else:
+            self.image_filesets[img_id] = None
+
+    def get_object(self, datatype: str, id: int) -> BlitzObjectWrapper:
+        key = (datatype, id)
+        if key not in self.objects and not self._load(datatype, [id]):
+            self.objects[key] = self.conn.getObject(datatype, id)
+        return self.objects.get(key)
+
+    def list_children(self, obj: BlitzObjectWrapper
+                      ) -> List[BlitzObjectWrapper]:
+        key = (obj.OMERO_CLASS, obj.getId())
+        child_type = self.CHILD_TYPES[obj.OMERO_CLASS]
+        if key not in self.children:
+            self._load(obj.OMERO_CLASS, [obj.getId()])
+        return [self.get_object(child_type, i)
+                for i in self.children.get(key, [])]
+
+    def list_fileset_images(self, obj: ImageWrapper
+                            ) -> List[BlitzObjectWrapper]:
+        img_id = obj.getId()
+        if img_id not in self.image_filesets:
+            self._load_images([img_id])
+        fs_id = self.image_filesets.get(img_id)
+        if fs_id is None:
+            return []
+        return [self.get_object("Image", i)
+                for i in self.fileset_images[fs_id]]
+
+    def original_filepaths(self, img_id: int) -> List[str]:
+        if img_id not in self.image_filesets:
+            self._load_images([img_id])
+        fs_id = self.image_filesets.get(img_id)
+        if fs_id is None:
+            return []
+        if fs_id not in self.fileset_paths:
+            self._load_fileset_paths([fs_id])
+        return self.fileset_paths[fs_id]
+
+    def common_root(self, img_id: int) -> Path:
+        fs_id = self.image_filesets.get(img_id)
+        if fs_id is not None and fs_id in self.fileset_roots:
+            return self.fileset_roots[fs_id]
+        allpaths = [Path(f).parts for f in self.original_filepaths(img_id)]
+        common_root = Path(*os.path.commonprefix(allpaths))
+        if fs_id is not None:
+            self.fileset_roots[fs_id] = common_root
+        return common_root
+
+    def provenance_context(self) -> Dict[str, str]:
+        if self.provenance is None:
+            self.provenance = create_provenance_context(self.conn)
+        return self.provenance
+
+    def list_rois(self, img_id: int) -> List[RoiI]:
+        if img_id not in self.rois:
+            roi_service = self.conn.getRoiService()
+            self.rois[img_id] = roi_service.findByImage(img_id, None).rois
+            self.prefetch_annotations("Roi", [r.getId().getValue()
+                                              for r in self.rois[img_id]])
+        return self.rois[img_id]
+
+    def list_annotations(self, datatype: str, id: int
+                         ) -> List[AnnotationWrapper]:
+        index = self.annotations.setdefault(datatype, {})
+        if id not in index:
+            index[id] = list(self.get_object(datatype, id).listAnnotations())
+        return index[id]
+
+
+class OMEBuilder:
+    """
+    Builds an OME object while keeping hash indexes of its elements by ID,
+    so that the populate_* functions can deduplicate and look up projects,
+    datasets, images, screens, plates, ROIs and annotations in constant
+    time instead of scanning the OME lists.
+    """
+
+    INDEXED = ("projects", "datasets", "images", "screens", "plates", "rois",
+               "structured_annotations")
+
+    def __init__(self, ome: Optional[OME] = None,
+                 writer: Optional["OMEWriter"] = None):
+        if ome is None:
+            ome = OME()
+        self.ome = ome
+        self.writer = writer
+        self.index: Dict[str, Dict[str, Any]] = {}
+        for collection in self.INDEXED:
+            self.index[collection] = {o.id: o for o in getattr(ome,
+                                                               collection)}
+
+    def contains(self, collection: str, id: str) -> bool:
+        return id in self.index[collection]
+
+    def get(self, collection: str, id: str) -> Any:
+        return self.index[collection].get(id)
+
+    def add(self, collection: str, obj: Any) -> bool:
+        """
+        Appends `obj` to `collection` unless an element with the same ID
+        is already there; returns whether it was added.
+        """
+        if obj.id in self.index[collection]:
+            return False
+        if self.writer is not None and self.writer.spools(collection):
+            if not self.writer.add(collection, obj):
+                # already written out, only its ID is kept for lookups
+                self.index[collection][obj.id] = None
+                return True
+        getattr(self.ome, collection).append(obj)
+        self.index[collection][obj.id] = obj
+        return True
+
+
+def populate_roi(obj: RoiI, builder: OMEBuilder, conn: BlitzGateway,
+                 cache: PackCache) -> Union[ROIRef, None]:
     id = obj.getId().getValue()
     name = obj.getName()
     if name is not None:
@@ -705,159 +1117,152 @@ def populate_roi(obj: RoiI, roi_obj: IObject, ome: OME, conn: BlitzGateway
         return None
     roi, roi_ref = create_roi_and_ref(id=id, name=name, description=desc,
                                       union=shapes)
-    for ann in roi_obj.listAnnotations():
-        add_annotation(roi, ann, ome, conn)
-    if roi not in ome.rois:
-        ome.rois.append(roi)
+    for ann in cache.list_annotations("Roi", id):
+        add_annotation(roi, ann, builder, conn)
+    builder.add("rois", roi)
     return roi_ref
 
 
-def populate_image(obj: ImageI, ome: OME, conn: BlitzGateway, hostname: str,
-                   metadata: List[str], simple: bool,
-                   fset: Union[None, Fileset] = None,
-                   ds: Optional[str] = None, proj: Optional[str] = None,
-                   ) -> ImageRef:
+def populate_image(obj: ImageI, builder: OMEBuilder, conn: BlitzGateway,
+                   hostname: str, metadata: List[str], simple: bool,
+                   cache: PackCache, ds: Optional[str] = None,
+                   proj: Optional[str] = None) -> ImageRef:
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     img_id = f"Image:{str(id)}"
-    if img_id in [i.id for i in ome.images]:
+    if builder.contains("images", img_id):
         img_ref = ImageRef(id=img_id)
         return img_ref
     pix = create_pixels(obj)
     img, img_ref = create_image_and_ref(id=id, name=name,
                                         description=desc, pixels=pix)
-    for ann in obj.listAnnotations():
-        add_annotation(img, ann, ome, conn)
-    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, False)
+    for ann in cache.list_annotations(obj.OMERO_CLASS, id):
+        add_annotation(img, ann, builder, conn)
+    context = cache.provenance_context() if metadata else None
+    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, False,
+                                         context)
     if kv:
-        kv_id = f"Annotation:{str(kv.id)}"
-        if kv_id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(kv)
+        builder.add("structured_annotations", kv)
         if ref:
             img.annotation_refs.append(ref)
     filepath_anns, refs = create_filepath_annotations(img_id, conn,
                                                       simple, ds=ds,
-                                                      proj=proj)
+                                                      proj=proj, cache=cache)
     for i in range(len(filepath_anns)):
-        ome.structured_annotations.append(filepath_anns[i])
+        builder.add("structured_annotations", filepath_anns[i])
         img.annotation_refs.append(refs[i])
-    roi_service = conn.getRoiService()
-    rois = roi_service.findByImage(id, None).rois
-    for roi in rois:
-        roi_obj = conn.getObject('Roi', roi.getId().getValue())
-        roi_ref = populate_roi(roi, roi_obj, ome, conn)
+    for roi in cache.list_rois(id):
+        roi_ref = populate_roi(roi, builder, conn, cache=cache)
         if not roi_ref:
             continue
         img.roi_ref.append(roi_ref)
-    img_id = f"Image:{str(img.id)}"
-    if img_id not in [i.id for i in ome.datasets]:
-        ome.images.append(img)
-    if not fset:
-        fset = obj.getFileset()
-    if fset:
-        for fs_image in fset.copyImages():
-            fs_img_id = f"Image:{str(fs_image.getId())}"
-            if fs_img_id not in [i.id for i in ome.images]:
-                populate_image(fs_image, ome, conn, hostname, metadata,
-                               simple, fset)
+    builder.add("images", img)
+    for fs_image in cache.list_fileset_images(obj):
+        fs_img_id = f"Image:{str(fs_image.getId())}"
+        if not builder.contains("images", fs_img_id):
+            populate_image(fs_image, builder, conn, hostname, metadata,
+                           simple, cache=cache)
     return img_ref
 
 
-def populate_dataset(obj: DatasetI, ome: OME, conn: BlitzGateway,
+def populate_dataset(obj: DatasetI, builder: OMEBuilder, conn: BlitzGateway,
                      hostname: str, metadata: List[str], simple: bool,
-                     proj: Optional[str] = None,
-                     ) -> DatasetRef:
+                     cache: PackCache,
+                     proj: Optional[str] = None) -> DatasetRef:
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     ds, ds_ref = create_dataset_and_ref(id=id, name=name,
                                         description=desc)
-    for ann in obj.listAnnotations():
-        add_annotation(ds, ann, ome, conn)
-    for img in obj.listChildren():
-        img_obj = conn.getObject('Image', img.getId())
-        img_ref = populate_image(img_obj, ome, conn, hostname, metadata,
+    for ann in cache.list_annotations(obj.OMERO_CLASS, id):
+        add_annotation(ds, ann, builder, conn)
+    for img_obj in cache.list_children(obj):
+        img_ref = populate_image(img_obj, builder, conn, hostname, metadata,
                                  simple, ds=str(id) + "_" + name,
-                                 proj=proj)
+                                 proj=proj, cache=cache)
         ds.image_refs.append(img_ref)
-    ds_id = f"Dataset:{str(ds.id)}"
-    if ds_id not in [i.id for i in ome.datasets]:
-        ome.datasets.append(ds)
+    builder.add("datasets", ds)
     return ds_ref
 
 
-def populate_project(obj: ProjectI, ome: OME, conn: BlitzGateway,
-                     hostname: str, metadata: List[str], simple: bool):
+def populate_project(obj: ProjectI, builder: OMEBuilder, conn: BlitzGateway,
+                     hostname: str, metadata: List[str], simple: bool,
+                     cache: PackCache):
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     proj, _ = create_proj_and_ref(id=id, name=name, description=desc)
-    for ann in obj.listAnnotations():
-        add_annotation(proj, ann, ome, conn)
+    for ann in cache.list_annotations(obj.OMERO_CLASS, id):
+        add_annotation(proj, ann, builder, conn)
 
-    for ds in obj.listChildren():
-        ds_obj = conn.getObject('Dataset', ds.getId())
-        ds_ref = populate_dataset(ds_obj, ome, conn, hostname, metadata,
-                                  simple, proj=str(id) + "_" + name)
+    for ds_obj in cache.list_children(obj):
+        ds_ref = populate_dataset(ds_obj, builder, conn, hostname, metadata,
+                                  simple, proj=str(id) + "_" + name,
+                                  cache=cache)
 
         proj.dataset_refs.append(ds_ref)
-    ome.projects.append(proj)
+    builder.add("projects", proj)
 
 
-def populate_screen(obj: ScreenI, ome: OME, conn: BlitzGateway,
-                    hostname: str, metadata: List[str]):
+def populate_screen(obj: ScreenI, builder: OMEBuilder, conn: BlitzGateway,
+                    hostname: str, metadata: List[str],
+                    cache: PackCache):
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     scr = create_screen(id=id, name=name, description=desc)
-    for ann in obj.listAnnotations():
-        add_annotation(scr, ann, ome, conn)
-    for pl in obj.listChildren():
-        pl_obj = conn.getObject('Plate', pl.getId())
-        pl_ref = populate_plate(pl_obj, ome, conn, hostname, metadata)
+    for ann in cache.list_annotations(obj.OMERO_CLASS, id):
+        add_annotation(scr, ann, builder, conn)
+    for pl_obj in cache.list_children(obj):
+        pl_ref = populate_plate(pl_obj, builder, conn, hostname, metadata,
+                                cache=cache)
         scr.plate_refs.append(pl_ref)
-    ome.screens.append(scr)
+    builder.add("screens", scr)
 
 
-def populate_plate(obj: PlateI, ome: OME, conn: BlitzGateway,
-                   hostname: str, metadata: List[str]) -> PlateRef:
+def populate_plate(obj: PlateI, builder: OMEBuilder, conn: BlitzGateway,
+                   hostname: str, metadata: List[str],
+                   cache: PackCache) -> PlateRef:
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     logger.info(f"populating plate {id}")
     pl, pl_ref = create_plate_and_ref(id=id, name=name, description=desc)
-    for ann in obj.listAnnotations():
-        add_annotation(pl, ann, ome, conn)
-    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, True)
+    for ann in cache.list_annotations(obj.OMERO_CLASS, id):
+        add_annotation(pl, ann, builder, conn)
+    context = cache.provenance_context() if metadata else None
+    kv, ref = create_provenance_metadata(conn, id, hostname, metadata, True,
+                                         context)
     if kv:
-        kv_id = f"Annotation:{str(kv.id)}"
-        if kv_id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(kv)
+        builder.add("structured_annotations", kv)
         if ref:
             pl.annotation_refs.append(ref)
-    for well in obj.listChildren():
-        well_obj = conn.getObject('Well', well.getId())
-        well_ref = populate_well(well_obj, ome, conn, hostname, metadata)
+    for well_obj in cache.list_children(obj):
+        well_ref = populate_well(well_obj, builder, conn, hostname, metadata,
+                                 cache=cache)
         pl.wells.append(well_ref)
 
     # this will need some changing to tackle XMLs
-    last_image_anns = ome.images[-1].annotation_refs
-    plate_path = get_server_path(last_image_anns, ome.structured_annotations)
+    last_image_anns = builder.ome.images[-1].annotation_refs
+    anns = [builder.get("structured_annotations", ref.id)
+            for ref in last_image_anns]
+    plate_path = ServerPathIndex(
+        [ann for ann in anns if ann is not None]
+    ).get(last_image_anns)
     filepath_anns, refs = create_filepath_annotations(pl.id, conn,
                                                       simple=False,
                                                       plate_path=plate_path)
     for i in range(len(filepath_anns)):
-        ome.structured_annotations.append(filepath_anns[i])
+        builder.add("structured_annotations", filepath_anns[i])
         pl.annotation_refs.append(refs[i])
-    pl_id = f"Plate:{str(pl.id)}"
-    if pl_id not in [i.id for i in ome.plates]:
-        ome.plates.append(pl)
+    builder.add("plates", pl)
     return pl_ref
 
 
-def populate_well(obj: WellI, ome: OME, conn: BlitzGateway,
-                  hostname: str, metadata: List[str]) -> Well:
+def populate_well(obj: WellI, builder: OMEBuilder, conn: BlitzGateway,
+                  hostname: str, metadata: List[str],
+                  cache: PackCache) -> Well:
     id = obj.getId()
     column = obj.getColumn()
     row = obj.getRow()
@@ -866,26 +1271,30 @@ def populate_well(obj: WellI, ome: OME, conn: BlitzGateway,
     for index in range(obj.countWellSample()):
         ws_obj = obj.getWellSample(index)
         ws_id = ws_obj.getId()
-        ws_img = ws_obj.getImage()
-        ws_img_ref = populate_image(ws_img, ome, conn, hostname, metadata,
-                                    simple=False)
+        ws_img = cache.get_object('Image', ws_obj.getImage().getId())
+        ws_img_ref = populate_image(ws_img, builder, conn, hostname, metadata,
+                                    simple=False, cache=cache)
         ws_index = int(ws_img_ref.id.split(":")[-1])
         ws = WellSample(id=ws_id, index=ws_index, image_ref=ws_img_ref)
         samples.append(ws)
     well = Well(id=id, row=row, column=column, well_samples=samples)
-    for ann in obj.listAnnotations():
-        add_annotation(well, ann, ome, conn)
+    for ann in cache.list_annotations(obj.OMERO_CLASS, id):
+        add_annotation(well, ann, builder, conn)
     return well
 
 
 def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
                               Well, ROI],
-                   ann: Annotation, ome: OME, conn: BlitzGateway):
+                   ann: Annotation, builder: OMEBuilder, conn: BlitzGateway):
+    ann_id = f"Annotation:{str(ann.getId())}"
+    if builder.contains("structured_annotations", ann_id):
+        # already packed through another object, only needs a new ref
+        obj.annotation_refs.append(AnnotationRef(id=ann_id))
+        return
     if ann.OMERO_TYPE == TagAnnotationI:
         tag, ref = create_tag_and_ref(id=ann.getId(),
                                       value=ann.getTextValue())
-        if tag.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(tag)
+        builder.add("structured_annotations", tag)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == MapAnnotationI:
@@ -899,30 +1308,26 @@ def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
                                     namespace=ann.getNs(),
                                     value=Map(
                                     ms=mmap))
-        if kv.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(kv)
+        builder.add("structured_annotations", kv)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == CommentAnnotationI:
         comm, ref = create_comm_and_ref(id=ann.getId(),
                                         value=ann.getTextValue())
-        if comm.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(comm)
+        builder.add("structured_annotations", comm)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == TimestampAnnotationI:
         ts, ref = create_ts_and_ref(id=ann.getId(),
                                     value=ann.getValue().isoformat())
-        if ts.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(ts)
+        builder.add("structured_annotations", ts)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == LongAnnotationI:
         long, ref = create_long_and_ref(id=ann.getId(),
                                         namespace=ann.getNs(),
                                         value=ann.getValue())
-        if long.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(long)
+        builder.add("structured_annotations", long)
         obj.annotation_ref.append(ref)
 
     elif ann.OMERO_TYPE == FileAnnotationI:
@@ -946,51 +1351,159 @@ def add_annotation(obj: Union[Project, Dataset, Image, Plate, Screen,
                                 simple=False,
                                 filename=ann.getFile().getName())
         for i in range(len(filepath_anns)):
-            ome.structured_annotations.append(filepath_anns[i])
+            builder.add("structured_annotations", filepath_anns[i])
             f.annotation_ref.append(refs[i])
-        if f.id not in [i.id for i in ome.structured_annotations]:
-            ome.structured_annotations.append(f)
+        builder.add("structured_annotations", f)
         obj.annotation_ref.append(ref)
 
 
 def list_file_ids(ome: OME) -> dict:
     id_list = {}
+    index = ServerPathIndex.from_ome(ome)
     for img in ome.images:
-        path = get_server_path(img.annotation_refs, ome.structured_annotations)
-        id_list[img.id] = path
+        id_list[img.id] = index.object_path(img.id)
     for ann in ome.structured_annotations:
         if isinstance(ann, FileAnnotation):
             if ann.namespace != "omero.web.figure.json":
-                path = get_server_path(ann.annotation_refs,
-                                       ome.structured_annotations)
-                id_list[ann.id] = path
+                id_list[ann.id] = index.object_path(ann.id)
     return id_list
 
 
+def _xml_fragment(obj: Any, depth: int) -> Iterator[str]:
+    # Serialize a single element and re-indent it to `depth` levels. Only
+    # lines that open or close a tag right after another tag are indented,
+    # so multi-line text values are written back untouched.
+    xml = _XML_NAMESPACES.sub("", to_xml(obj), count=1)
+    pad = "  " * depth
+    prev = ">"
+    for line in xml.splitlines(True):
+        if prev.endswith(">") and line.lstrip(" ").startswith("<"):
+            yield pad + line
+        else:
+            yield line
+        prev = line.rstrip("\n")
+
+
+def _write_ome(fp: TextIO, ome: OME, spools: Dict[str, TextIO]):
+    # Elements of the collections in `spools` are read back from there,
+    # already serialized, instead of from `ome`.
+    root = to_xml(OME(uuid=ome.uuid, creator=ome.creator)).rstrip()
+    fp.write(root[:-2] + ">\n")
+    for field in OME.model_fields:
+        if field in ("uuid", "creator"):
+            continue
+        value = getattr(ome, field)
+        if field in spools:
+            spool = spools[field]
+            if spool.tell() == 0:
+                continue
+            spool.seek(0)
+            fragments = spool
+        elif field == "structured_annotations" or isinstance(value, list):
+            if len(value) == 0:
+                continue
+            depth = 2 if field == "structured_annotations" else 1
+            fragments = (line for elem in value
+                         for line in _xml_fragment(elem, depth))
+        elif value is not None:
+            fragments = _xml_fragment(value, 1)
+        else:
+            continue
+        if field == "structured_annotations":
+            fp.write("  <StructuredAnnotations>\n")
+        fp.writelines(fragments)
+        if field == "structured_annotations":
+            fp.write("  </StructuredAnnotations>\n")
+    fp.write("</OME>\n")
+
+
+def write_ome_xml(ome: OME, filepath: str):
+    """Write `ome` to `filepath` one top-level element at a time.
+
+    The output matches ``to_xml(ome)``, but the serialized document is never
+    held in memory as a single string. To avoid building the whole `OME`
+    model in the first place, use an `OMEWriter`.
+    """
+    with open(filepath, 'w') as fp:
+        _write_ome(fp, ome, {})
+
+
+class OMEWriter:
+    """
+    Writes a transfer.xml while it is being populated. ROIs and annotations
+    are serialized to temporary files as an `OMEBuilder` receives them and
+    are then dropped from the `OME` model, so that memory does not grow
+    with the number of shapes or annotations; `write` puts them back in
+    place and writes the file once, with the same contents as
+    ``write_ome_xml``.
+
+    Transfer XMLAnnotations and FileAnnotations are also kept in the
+    model, as the pack still needs them to find the files to download.
+    """
+
+    SPOOLED = {"structured_annotations": 2, "rois": 1}
+    RETAINED = (XMLAnnotation, FileAnnotation)
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        folder = os.path.dirname(os.path.abspath(filepath))
+        self._spools = {collection: tempfile.TemporaryFile('w+', dir=folder)
+                        for collection in self.SPOOLED}
+
+    def spools(self, collection: str) -> bool:
+        return collection in self._spools
+
+    def add(self, collection: str, obj: Any) -> bool:
+        """
+        Serializes `obj` at the end of `collection`; returns whether it
+        must also be kept in the model.
+        """
+        self._spools[collection].writelines(
+            _xml_fragment(obj, self.SPOOLED[collection]))
+        return isinstance(obj, self.RETAINED)
+
+    def write(self, ome: OME):
+        """Write `ome`, plus everything spooled so far, to the file."""
+        try:
+            with open(self.filepath, 'w') as fp:
+                _write_ome(fp, ome, self._spools)
+        finally:
+            self.close()
+
+    def close(self):
+        for spool in self._spools.values():
+            spool.close()
+
+
 def populate_xml(datatype: str, id: int, filepath: str, conn: BlitzGateway,
                  hostname: str, barchive: bool, simple: bool, figure: bool,
-                 metadata: List[str]) -> Tuple[OME, dict]:
-    ome = OME()
+                 metadata: List[str],
+                 provenance: Optional[Dict[str, str]] = None,
+                 writer: Optional[OMEWriter] = None
+                 ) -> Tuple[OME, dict]:
+    builder = OMEBuilder(writer=writer)
     # Create a throw-away annotation so we can reset the auto-id-numbering to a
     # very high random value.
     CommentAnnotation(id=uuid4().int >> 64, value="")
-    obj = conn.getObject(datatype, id)
+    cache = PackCache(conn, provenance)
+    cache.prefetch(datatype, [id])
+    obj = cache.get_object(datatype, id)
+    ome = builder.ome
     if datatype == 'Project':
-        populate_project(obj, ome, conn, hostname, metadata, simple)
+        populate_project(obj, builder, conn, hostname, metadata, simple,
+                         cache=cache)
     elif datatype == 'Dataset':
-        populate_dataset(obj, ome, conn, hostname, metadata, simple)
+        populate_dataset(obj, builder, conn, hostname, metadata, simple,
+                         cache=cache)
     elif datatype == 'Image':
-        populate_image(obj, ome, conn, hostname, metadata, simple)
+        populate_image(obj, builder, conn, hostname, metadata, simple,
+                       cache=cache)
     elif datatype == 'Screen':
-        populate_screen(obj, ome, conn, hostname, metadata)
+        populate_screen(obj, builder, conn, hostname, metadata, cache=cache)
     elif datatype == 'Plate':
-        populate_plate(obj, ome, conn, hostname, metadata)
+        populate_plate(obj, builder, conn, hostname, metadata, cache=cache)
     if (not (barchive or simple)) and figure:
-        populate_figures(ome, conn, filepath)
-    if not barchive:
-        with open(filepath, 'w') as fp:
-            print(to_xml(ome), file=fp)
-            fp.close()
+        populate_figures(builder, conn, filepath)
     path_id_dict = list_file_ids(ome)
     return ome, path_id_dict
 
@@ -1008,9 +1521,7 @@ def populate_xml_folder(folder: str, filelist: bool) -> Tuple[OME, dict]:
             filepath = str(Path(folder) / "transfer.xml")
         else:
             raise ValueError("Folder cannot be found!")
-    with open(filepath, 'w') as fp:
-        print(to_xml(ome), file=fp)
-        fp.close()
+    write_ome_xml(ome, filepath)
     path_id_dict = list_file_ids(ome)
     return ome, path_id_dict
 
@@ -1056,11 +1567,11 @@ def populate_rocrate(datatype: str, ome: OME, filepath: str,
     return
 
 
-def populate_figures(ome: OME, conn: BlitzGateway, filepath: str):
+def populate_figures(builder: OMEBuilder, conn: BlitzGateway, filepath: str):
     cli = CLI()
     cli.loadplugins()
     clean_img_ids = []
-    for img in ome.images:
+    for img in builder.ome.images:
         clean_img_ids.append(img.id.split(":")[-1])
     q = conn.getQueryService()
     params = Parameters()
@@ -1103,9 +1614,9 @@ def populate_figures(ome: OME, conn: BlitzGateway, filepath: str):
                                            namespace=fig_obj.getNs(),
                                            binary_file=binaryfile)
             filepath_ann, ref = create_figure_annotations(f.id)
-            ome.structured_annotations.append(filepath_ann)
+            builder.add("structured_annotations", filepath_ann)
             f.annotation_refs.append(ref)
-            ome.structured_annotations.append(f)
+            builder.add("structured_annotations", f)
         else:
             os.remove(filepath)
     if not os.listdir(figure_dir):
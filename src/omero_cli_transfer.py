@@ -15,22 +15,32 @@ import sys
 import os
 import copy
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
 import shutil
+import tarfile
+import threading
+import time
 from typing import DefaultDict
 import hashlib
-from zipfile import ZipFile
+import json
+import tempfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 from typing import Callable, List, Any, Dict, Union, Optional, Tuple
-import xml.etree.cElementTree as ETree
+from typing import Iterator
 
 from generate_xml import populate_xml, populate_tsv, populate_rocrate
-from generate_xml import populate_xml_folder
-from generate_omero_objects import populate_omero, get_server_path
+from generate_xml import populate_xml_folder, create_provenance_context
+from generate_xml import write_ome_xml, find_ids_by_ids, OMEWriter
+from generate_omero_objects import populate_omero, ServerPathIndex
 
 import ezomero
-from ome_types.model import XMLAnnotation, OME
-from ome_types import from_xml, to_xml
+import Ice
+from ome_types.model import OME, StructuredAnnotations
+from ome_types import from_xml
+import omero
 from omero.sys import Parameters
-from omero.rtypes import rstring
+from omero.rtypes import rstring, rlong, rlist, unwrap
 from omero.cli import CLI, GraphControl, GraphArg
 from omero.cli import NonZeroReturnCode
 from omero.gateway import BlitzGateway
@@ -44,6 +54,11 @@ logger.setLevel(logging.INFO)
 
 DIR_PERM = 0o755
 MD5_BUF_SIZE = 65536
+READ_BUF_SIZE = 8 * 1024 * 1024
+ROI_DELETE_BATCH_SIZE = 5000
+DOWNLOAD_BLOCK_SIZE = 8 * 1024 * 1024
+# bytes of an Ice reply not taken by the block itself
+MESSAGE_OVERHEAD = 64 * 1024
 
 
 HELP = ("""Transfer objects and annotations between servers.
@@ -105,6 +120,23 @@ With `none`, only the `transfer.xml` file is created, in which case
 the last cli argument is the path where the `transfer.xml` file
 will be written.
 
+--workers sets how many filesets and file annotations are downloaded in
+parallel, each worker using its own connection joined to your current
+session. Default is 1 (sequential downloads).
+
+--block_size sets the size, in MiB, of the blocks in which files are read
+from the server while downloading. Default is 8.
+
+--stream writes downloaded files straight into the .tar or .zip pack instead
+of first downloading everything to a staging folder, halving disk usage and
+I/O. Only available for regular packs (no special export types or plugins);
+downloads then run one at a time regardless of --workers.
+
+--resume makes a pack resumable: finished downloads are recorded in the
+staging folder, `<filepath>_folder`, which is kept if a download fails. Running
+the same command with --resume again skips the downloads recorded by the
+previous run. Without --resume, the staging folder of a failed pack is removed.
+
 Examples:
 omero transfer pack Image:123 transfer_pack.tar
 omero transfer pack Image:123 transfer_pack.zip
@@ -114,6 +146,9 @@ omero transfer pack 999 tarfile.tar  # equivalent to Project:999
 omero transfer pack 1 transfer_pack.tar --metadata img_id version db_id
 omero transfer pack --binaries none Dataset:1111 /home/user/new_folder/
 omero transfer pack --binaries all Dataset:1111 /home/user/new_folder/pack.tar
+omero transfer pack --workers 4 Project:999 /home/user/new_folder/pack.tar
+omero transfer pack --stream Project:999 /home/user/new_folder/pack.tar
+omero transfer pack --resume Project:999 /home/user/new_folder/pack.tar
 """)
 
 UNPACK_HELP = ("""Unpacks a transfer packet into an OMERO hierarchy.
@@ -147,6 +182,16 @@ exist on `transfer.xml` will be ignored. Default is `all` (equivalent to
 options are `none`, `img_id`, `timestamp`, `software`, `version`, `md5`,
 `hostname`, `db_id`, `orig_user`, `orig_group`.
 
+--import_workers sets how many filesets are imported in parallel, each import
+using its own connection joined to your current session. Default is 1
+(sequential imports).
+
+--read_buffer sets the size, in MiB, of the buffer used to read the pack
+while extracting it. Default is 8. The pack digest (used by the `md5`
+metadata field) is computed while a tar pack is extracted; for zip packs it is
+read from the `<pack>.md5` file created next to it at pack time if present,
+and computed in a separate pass otherwise.
+
 You can also pass all --skip options that are allowed by `omero import` (all,
 checksum, thumbnails, minmax, upgrade).
 
@@ -155,6 +200,7 @@ omero transfer unpack transfer_pack.zip
 omero transfer unpack --output /home/user/optional_folder --ln_s
 omero transfer unpack --folder /home/user/unpacked_folder/ --skip upgrade
 omero transfer unpack pack.tar --metadata db_id orig_user hostname
+omero transfer unpack pack.tar --import_workers 4
 """)
 
 PREPARE_HELP = ("""Creates an XML from a folder with images.
@@ -219,6 +265,480 @@ def default_project_graph_arg(input):
     return ret
 
 
+def file_md5(path: str, buf_size: int = MD5_BUF_SIZE) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(buf_size)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def md5_sidecar_path(filepath: str) -> str:
+    return filepath + ".md5"
+
+
+def read_md5_sidecar(filepath: str) -> Optional[str]:
+    # The digest written next to a pack when it was created, as long as
+    # it is not older than the pack itself
+    sidecar = md5_sidecar_path(filepath)
+    if not os.path.exists(sidecar) or \
+       os.path.getmtime(sidecar) < os.path.getmtime(filepath):
+        return None
+    with open(sidecar) as fp:
+        fields = fp.read().split()
+    if len(fields) != 2 or fields[1] != os.path.basename(filepath):
+        return None
+    return fields[0]
+
+
+def max_block_size(client: Optional[omero.client]) -> Optional[int]:
+    """Largest block that can be read in one call under the client's
+    Ice.MessageSizeMax (given in KiB), or None if there is no limit."""
+    if client is None:
+        return None
+    max_kb = client.getProperty("Ice.MessageSizeMax")
+    if not max_kb or int(max_kb) <= 0:
+        return None
+    # leave room for the rest of the reply
+    return max(int(max_kb) * 1024 - MESSAGE_OVERHEAD, 1)
+
+
+def parse_import_ids(output: str) -> Tuple[List[int], List[int]]:
+    # Image and Plate IDs from `omero import --output ids`, which prints
+    # lines like `Image:1,2,3` or `Plate:4`
+    ids = {"Image": set(), "Plate": set()}
+    for line in output.splitlines():
+        dtype, _, id_list = line.strip().partition(":")
+        if dtype in ids:
+            ids[dtype].update(int(i) for i in id_list.split(",")
+                              if i.strip().isdigit())
+    return sorted(ids["Image"]), sorted(ids["Plate"])
+
+
+class _HashingReader:
+    """Read-only file object that computes the MD5 of what it reads."""
+
+    def __init__(self, fp: Any):
+        self._fp = fp
+        self.md5 = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fp.read(size)
+        self.md5.update(data)
+        return data
+
+
+class _HashingWriter:
+    """Write-only, non-seekable file object that computes the MD5 of what
+    is written through it. Not being seekable makes zipfile write members
+    strictly sequentially.
+    """
+
+    def __init__(self, fp: Any):
+        self._fp = fp
+        self._pos = 0
+        self.md5 = hashlib.md5()
+
+    def write(self, data: bytes) -> int:
+        self.md5.update(data)
+        self._pos += len(data)
+        return self._fp.write(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        self._fp.flush()
+
+
+class _BlockReader:
+    """Read-only file object over an iterator of byte blocks."""
+
+    def __init__(self, blocks: Iterator[bytes]):
+        self._blocks = blocks
+        self._buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            parts.append(block)
+            length += len(block)
+        data = b"".join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class ArchiveWriter:
+    """Writes pack contents straight into a .tar or .zip file.
+
+    Methods take local paths under `root` (the pack staging folder), which
+    are stored relative to it - the same member names `shutil.make_archive`
+    produces for that folder. The MD5 of the archive is computed while it
+    is written and saved next to it (see `md5_sidecar_path`), so unpack
+    does not need a separate pass over the file.
+    """
+
+    def __init__(self, dest_path: str, root: str,
+                 block_size: int = DOWNLOAD_BLOCK_SIZE):
+        self.dest_path = dest_path
+        self.root = root
+        self._names = set()
+        self._tar = None
+        self._zip = None
+        ext = os.path.splitext(dest_path)[1]
+        if ext not in (".tar", ".zip"):
+            raise ValueError("Only .tar and .zip archives can be written "
+                             "directly")
+        self._file = open(dest_path, "wb")
+        self._out = _HashingWriter(self._file)
+        if ext == ".tar":
+            self._tar = tarfile.open(fileobj=self._out, mode="w",
+                                     copybufsize=block_size)
+        else:
+            self._zip = ZipFile(self._out, "w", ZIP_DEFLATED,
+                                allowZip64=True)
+
+    def _arcname(self, path: str) -> str:
+        name = Path(os.path.relpath(path, self.root)).as_posix()
+        if self._tar is not None:
+            return "./" + name if name != "." else name
+        return name
+
+    def _add_dirs(self, path: str):
+        # directory entries for `path` and its parents, as make_archive
+        # writes them (tar has a "." root entry, zip has none)
+        rel = Path(os.path.relpath(path, self.root))
+        if rel.parts and rel.parts[0] == "..":
+            return
+        dirs = [self.root] if self._tar is not None else []
+        for i in range(len(rel.parts)):
+            dirs.append(os.path.join(self.root, *rel.parts[:i + 1]))
+        for dirpath in dirs:
+            arcname = self._arcname(dirpath)
+            if self._zip is not None:
+                arcname += "/"
+            if arcname in self._names:
+                continue
+            self._names.add(arcname)
+            if self._tar is not None:
+                info = tarfile.TarInfo(arcname)
+                info.type = tarfile.DIRTYPE
+                info.mtime = int(time.time())
+                info.mode = DIR_PERM
+                self._tar.addfile(info)
+            else:
+                info = ZipInfo(arcname, date_time=time.localtime()[:6])
+                info.external_attr = (0o40000 | DIR_PERM) << 16 | 0x10
+                self._zip.writestr(info, b"")
+
+    def contains(self, path: str) -> bool:
+        return self._arcname(path) in self._names
+
+    def write_stream(self, path: str, size: int, blocks: Iterator[bytes]):
+        self._add_dirs(os.path.dirname(path))
+        arcname = self._arcname(path)
+        self._names.add(arcname)
+        try:
+            if self._tar is not None:
+                info = tarfile.TarInfo(arcname)
+                info.size = size
+                info.mtime = int(time.time())
+                info.mode = 0o644
+                self._tar.addfile(info, _BlockReader(blocks))
+            else:
+                info = ZipInfo(arcname, date_time=time.localtime()[:6])
+                info.compress_type = ZIP_DEFLATED
+                info.file_size = size
+                with self._zip.open(info, "w") as fp:
+                    for data in blocks:
+                        fp.write(data)
+        except Exception as e:
+            # a partially written member cannot be rolled back
+            raise RuntimeError(f"Could not write {arcname} to "
+                               f"{self.dest_path}") from e
+
+    def add_file(self, path: str):
+        self._add_dirs(os.path.dirname(path))
+        arcname = self._arcname(path)
+        self._names.add(arcname)
+        if self._tar is not None:
+            self._tar.add(path, arcname)
+        else:
+            self._zip.write(path, arcname)
+
+    def add_tree(self):
+        # add whatever was staged locally (transfer.xml, figures, exports)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            self._add_dirs(dirpath)
+            for filename in sorted(filenames):
+                if dirpath == self.root and \
+                   filename == PackCheckpoint.FILENAME:
+                    continue
+                path = os.path.join(dirpath, filename)
+                if not self.contains(path):
+                    self.add_file(path)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._tar is not None:
+            self._tar.close()
+        else:
+            self._zip.close()
+        self._file.close()
+        with open(md5_sidecar_path(self.dest_path), "w") as fp:
+            fp.write(f"{self._out.md5.hexdigest()}  "
+                     f"{os.path.basename(self.dest_path)}\n")
+
+    def discard(self):
+        try:
+            self.close()
+        except Exception:
+            self._file.close()
+        for path in (self.dest_path, md5_sidecar_path(self.dest_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class RawFileDownloader:
+    """Downloads OriginalFiles in-process through a single RawFileStore.
+
+    The store is opened on first use and reused for every file, so an
+    instance must not be shared between threads. With an `archive`, files
+    are written into it instead of to their target paths.
+    """
+
+    def __init__(self, client: omero.client,
+                 block_size: int = DOWNLOAD_BLOCK_SIZE,
+                 archive: Optional[ArchiveWriter] = None):
+        self.client = client
+        self.block_size = block_size
+        self.archive = archive
+        self.ctx = {'omero.group': '-1'}
+        self._store = None
+
+    def close(self):
+        if self._store is not None:
+            try:
+                self._store.close()
+            except Exception as e:
+                logger.debug(f"Could not close RawFileStore: {e}")
+            self._store = None
+
+    def _find(self, query: str, obj_id: int) -> Any:
+        params = Parameters()
+        params.map = {"id": rlong(obj_id)}
+        return self.client.sf.getQueryService().findByQuery(query, params,
+                                                            self.ctx)
+
+    def download_fileset(self, fileset_id: int, dir_path: str
+                         ) -> List[Tuple[str, int, Optional[str]]]:
+        # same layout as `omero download Image:<id>`
+        fileset = self._find("SELECT f FROM Fileset f "
+                             "JOIN FETCH f.usedFiles fe "
+                             "JOIN FETCH fe.originalFile "
+                             "WHERE f.id = :id", fileset_id)
+        if fileset is None:
+            raise omero.ClientError(f"No Fileset with ID {fileset_id}")
+        template_prefix = unwrap(fileset.templatePrefix)
+        files = []
+        for entry in fileset.copyUsedFiles():
+            orig_file = entry.originalFile
+            file_path = unwrap(orig_file.path).replace(template_prefix, "")
+            target_dir = os.path.join(dir_path, file_path)
+            if self.archive is None:
+                os.makedirs(target_dir, exist_ok=True)
+            target_path = os.path.join(target_dir, unwrap(orig_file.name))
+            files.append(self.download_file(orig_file, target_path))
+        return files
+
+    def download_annotation(self, ann_id: int, target_path: str
+                            ) -> List[Tuple[str, int, Optional[str]]]:
+        orig_file = self._find("SELECT f FROM FileAnnotation fa "
+                               "JOIN fa.file f WHERE fa.id = :id", ann_id)
+        if orig_file is None:
+            raise omero.ClientError(f"No FileAnnotation with ID {ann_id}")
+        return [self.download_file(orig_file, target_path)]
+
+    def download_file(self, orig_file: omero.model.OriginalFile,
+                      target_path: str) -> Tuple[str, int, Optional[str]]:
+        # Returns the path, size and MD5 of the file (no MD5 if it was
+        # already there and got skipped)
+        file_id = orig_file.id.val
+        if self.archive is not None:
+            exists = self.archive.contains(target_path)
+        else:
+            exists = os.path.exists(target_path)
+        if exists:
+            logger.info(f"{target_path} exists, skipping download.")
+            size = 0 if self.archive else os.path.getsize(target_path)
+            return target_path, size, None
+        perms = orig_file.details.permissions
+        if perms.isRestricted(omero.constants.permissions.BINARYACCESS):
+            raise omero.ClientError(f"Download of OriginalFile:{file_id} "
+                                    "is restricted")
+        if self._store is None:
+            self._store = self.client.sf.createRawFileStore()
+        # write under a temporary name, so that an interrupted download
+        # is never mistaken for a complete file
+        part_path = target_path + ".part"
+        md5 = hashlib.md5()
+        try:
+            self._store.setFileId(file_id, self.ctx)
+            size = self._store.size()
+            blocks = self._read_blocks(file_id, size, md5)
+            if self.archive is not None:
+                # read the first block before anything is written, so
+                # that most download errors leave the archive untouched
+                first = next(blocks, b"")
+                self.archive.write_stream(target_path, size,
+                                          chain([first], blocks))
+            else:
+                with open(part_path, 'wb') as fp:
+                    for data in blocks:
+                        fp.write(data)
+                os.replace(part_path, target_path)
+        except BaseException:
+            # the store may be unusable after a failure
+            self.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return target_path, size, md5.hexdigest()
+
+    def _read_blocks(self, file_id: int, size: int, md5: Any
+                     ) -> Iterator[bytes]:
+        offset = 0
+        while offset < size:
+            length = min(self.block_size, size - offset)
+            data = self._store.read(offset, length)
+            if not data:
+                raise omero.ClientError(f"Short read on "
+                                        f"OriginalFile:{file_id}")
+            offset += len(data)
+            md5.update(data)
+            yield data
+
+    def add_local_file(self, path: str):
+        # move a file written by another tool (e.g. `omero export`) into
+        # the archive
+        if self.archive is not None:
+            self.archive.add_file(path)
+            os.remove(path)
+
+
+class PackCheckpoint:
+    """Keeps track of finished downloads in a pack staging folder.
+
+    Every completed download job is appended to a JSON-lines manifest in
+    the folder, with the relative path, size and MD5 of each file it
+    wrote, so that an interrupted pack can be resumed without fetching
+    those files again.
+    """
+
+    FILENAME = ".transfer_checkpoint.jsonl"
+
+    def __init__(self, folder: str, resume: bool = False):
+        self.folder = folder
+        self.path = os.path.join(folder, self.FILENAME)
+        self.done = {}
+        self._lock = threading.Lock()
+        if resume and os.path.exists(self.path):
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut short by an interrupted run
+                        continue
+                    self.done[entry["job"]] = entry["files"]
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def _key(job: Tuple[str, Any, str]) -> str:
+        return f"{job[0]}:{job[1]}"
+
+    def is_done(self, job: Tuple[str, Any, str]) -> bool:
+        files = self.done.get(self._key(job))
+        if files is None:
+            return False
+        for f in files:
+            path = os.path.join(self.folder, f["path"])
+            if not os.path.isfile(path) or \
+               os.path.getsize(path) != f["size"]:
+                return False
+            # files that were already present when recorded have no digest
+            if f["md5"] is not None and file_md5(path) != f["md5"]:
+                return False
+        return True
+
+    def record(self, job: Tuple[str, Any, str],
+               files: List[Tuple[str, int, Optional[str]]]):
+        entry = {"job": self._key(job), "files": [
+            {"path": os.path.relpath(path, self.folder), "size": size,
+             "md5": md5} for path, size, md5 in files]}
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(entry) + "\n")
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_in_workers(func: Callable[[CLI, Any, Any], Any], items: List[Any],
+                   workers: int, connect: Callable[[], Any],
+                   disconnect: Callable[[Any], None]) -> List[Any]:
+    """
+    Calls ``func(cli, conn, item)`` for every item in a pool of `workers`
+    threads and returns the results in the order of `items`.
+
+    Each worker thread gets its own CLI and its own `conn`, made by
+    `connect` (usually from a client joined to the current session) the
+    first time the thread runs an item and given to `disconnect` once the
+    pool is done. If an item fails, the queued ones are dropped and the
+    error is raised once the running ones have finished.
+    """
+    local = threading.local()
+    conns = []
+    lock = threading.Lock()
+
+    def run(item):
+        if not hasattr(local, "conn"):
+            local.cli = CLI()
+            local.cli.loadplugins()
+            local.conn = connect()
+            with lock:
+                conns.append(local.conn)
+        return func(local.cli, local.conn, item)
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(run, item) for item in items]
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        pool.shutdown()
+        for conn in conns:
+            disconnect(conn)
+    return [future.result() for future in futures]
+
+
 class TransferControl(GraphControl):
 
     def _configure(self, parser):
@@ -266,6 +786,23 @@ class TransferControl(GraphControl):
         pack.add_argument(
                 "--plugin", help="Use external plugin for packing.",
                 type=str)
+        pack.add_argument(
+                "--workers", help="Number of files to download in parallel "
+                                  "(default 1)",
+                type=int, default=1)
+        pack.add_argument(
+                "--stream", help="Write downloaded files straight into the "
+                                 "tar/zip file, without a staging folder",
+                action="store_true")
+        pack.add_argument(
+                "--resume", help="Keep the staging folder if downloading "
+                                 "fails, and skip files already downloaded "
+                                 "by a previous --resume run",
+                action="store_true")
+        pack.add_argument(
+                "--block_size", help="Block size in MiB used when "
+                                     "downloading files (default 8)",
+                type=int, default=8)
         pack.add_argument("filepath", type=str, help=file_help)
         pack.add_argument(
             "--binaries",
@@ -295,6 +832,15 @@ class TransferControl(GraphControl):
             "--output", type=str, help="Output directory where zip "
                                        "file will be extracted"
         )
+        unpack.add_argument(
+            "--import_workers", type=int, default=1,
+            help="Number of filesets to import in parallel (default 1)"
+        )
+        unpack.add_argument(
+            "--read_buffer", type=int, default=8,
+            help="Read buffer size in MiB used to extract the pack "
+                 "(default 8)"
+        )
         unpack.add_argument(
             "--skip", choices=['all', 'checksum', 'thumbnails', 'minmax',
                                'upgrade'],
@@ -341,7 +887,10 @@ class TransferControl(GraphControl):
         return mrepos
 
     def _copy_files(self, id_list: Dict[str, Any], folder: str,
-                    ignore_errors: bool, conn: BlitzGateway):
+                    ignore_errors: bool, conn: BlitzGateway,
+                    workers: int = 1, block_size: int = DOWNLOAD_BLOCK_SIZE,
+                    archive: Optional[ArchiveWriter] = None,
+                    checkpoint: Optional[PackCheckpoint] = None):
         if not isinstance(id_list, dict):
             raise TypeError("id_list must be a dict")
         if not all(isinstance(item, str) for item in id_list.keys()):
@@ -350,8 +899,58 @@ class TransferControl(GraphControl):
             raise TypeError("folder must be a string")
         if not isinstance(conn, BlitzGateway):
             raise TypeError("invalid type for connection object")
-        cli = CLI()
-        cli.loadplugins()
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("workers must be a positive integer")
+        if not isinstance(block_size, int) or block_size < 1:
+            raise ValueError("block_size must be a positive integer")
+        max_size = max_block_size(conn.c)
+        if max_size is not None and block_size > max_size:
+            logger.warning(f"Block size of {block_size} bytes is above the "
+                           "Ice.MessageSizeMax of this session; using "
+                           f"{max_size} bytes instead.")
+            block_size = max_size
+        if archive is not None and workers > 1:
+            logger.warning("Files are written to the archive one at a time;"
+                           " ignoring the number of workers.")
+            workers = 1
+        jobs = self._list_copy_jobs(id_list, folder, conn)
+        if checkpoint is not None:
+            remaining = [job for job in jobs if not checkpoint.is_done(job)]
+            if len(remaining) < len(jobs):
+                logger.info(f"Skipping {len(jobs) - len(remaining)} "
+                            "downloads completed by a previous run.")
+            jobs = remaining
+        try:
+            if workers == 1:
+                cli = CLI()
+                cli.loadplugins()
+                downloader = RawFileDownloader(conn.c, block_size, archive)
+                try:
+                    for job in jobs:
+                        files = self._run_copy_job(cli, downloader, job,
+                                                   ignore_errors)
+                        if checkpoint is not None and files is not None:
+                            checkpoint.record(job, files)
+                finally:
+                    downloader.close()
+            else:
+                self._run_copy_jobs(jobs, ignore_errors, conn, workers,
+                                    block_size, checkpoint)
+        except NonZeroReturnCode:
+            if checkpoint is not None:
+                logger.warning(f"Completed downloads were kept in {folder};"
+                               " run the same command with --resume to "
+                               "continue.")
+            else:
+                shutil.rmtree(folder)
+            raise NonZeroReturnCode(1, "Download not allowed")
+
+    def _list_copy_jobs(self, id_list: Dict[str, Any], folder: str,
+                        conn: BlitzGateway) -> List[Tuple[str, Any, str]]:
+        # Resolve every download/export upfront (creating the target
+        # folders) so that each fileset is only fetched once, no matter
+        # how the jobs are later spread across workers.
+        jobs = []
         downloaded_ids = []
         for id in id_list:
             clean_id = int(id.split(":")[-1])
@@ -368,36 +967,10 @@ class TransferControl(GraphControl):
                     if rel_path == "pixel_images" or fileset is None:
                         filepath = str(Path(subfolder) /
                                        (str(clean_id) + ".tiff"))
-                        if not ignore_errors:
-                            try:
-                                cli.invoke(['export', '--file', filepath, id],
-                                           strict=True)
-                            except NonZeroReturnCode:
-                                logger.warning("A file could not be exported -"
-                                               " this is generally due"
-                                               " to a server not allowing"
-                                               " binary downloads.")
-                                shutil.rmtree(folder)
-                                raise NonZeroReturnCode(1, "Download not \
-                                                        allowed")
-                        else:
-                            cli.invoke(['export', '--file', filepath, id])
-                        downloaded_ids.append(id)
+                        jobs.append(("export", id, filepath))
+                        downloaded_ids.append(clean_id)
                     else:
-                        if not ignore_errors:
-                            try:
-                                cli.invoke(['download', id, subfolder],
-                                           strict=True)
-                            except NonZeroReturnCode:
-                                logger.warning("A file could not be downloaded"
-                                               " - this is generally"
-                                               " due to a server not"
-                                               " allowing binary downloads.")
-                                shutil.rmtree(folder)
-                                raise NonZeroReturnCode(1, "Download not \
-                                                        allowed")
-                        else:
-                            cli.invoke(['download', id, subfolder])
+                        jobs.append(("fileset", fileset.getId(), subfolder))
                         for fs_image in fileset.copyImages():
                             downloaded_ids.append(fs_image.getId())
             else:
@@ -406,29 +979,78 @@ class TransferControl(GraphControl):
                 subfolder = os.path.join(str(Path(folder)), rel_path)
                 ann_folder = str(Path(subfolder).parent)
                 os.makedirs(ann_folder, mode=DIR_PERM, exist_ok=True)
-                id = "File" + id
-                if not ignore_errors:
-                    try:
-                        cli.invoke(['download', id, subfolder], strict=True)
-                    except NonZeroReturnCode:
-                        logger.warning("A file could not be downloaded - this "
-                                       "is generally due to a server not "
-                                       "allowing binary downloads.")
-                        shutil.rmtree(folder)
-                        raise NonZeroReturnCode(1, "Download not allowed")
-                else:
-                    cli.invoke(['download', id, subfolder])
-
-    def _package_files(self, dest_path: str, folder: str):
-        basepath, ext = os.path.splitext(dest_path)
-        if ext == ".tar":
-            logger.info("Creating tar file...")
-            shutil.make_archive(basepath, 'tar', folder)
-            logger.info("Cleaning up...")
-            shutil.rmtree(folder)
-        elif ext == ".zip":
-            logger.info("Creating zip file...")
-            shutil.make_archive(basepath, 'zip', folder)
+                jobs.append(("file", clean_id, subfolder))
+        return jobs
+
+    def _run_copy_job(self, cli: CLI, downloader: RawFileDownloader,
+                      job: Tuple[str, Any, str], ignore_errors: bool,
+                      client: Optional[omero.client] = None
+                      ) -> Optional[List[Tuple[str, int, Optional[str]]]]:
+        # Returns path, size and MD5 of the files written by the job, or
+        # None if it failed and errors are ignored
+        kind, obj_id, target = job
+        try:
+            if kind == "export":
+                if client is not None:
+                    # the CLI closes its client once the command is done
+                    cli.set_client(client.createClient(True))
+                cli.invoke(['export', '--file', target, obj_id],
+                           strict=True)
+                if downloader.archive is not None:
+                    downloader.add_local_file(target)
+                    return []
+                return [(target, os.path.getsize(target),
+                         file_md5(target))]
+            elif kind == "fileset":
+                return downloader.download_fileset(obj_id, target)
+            else:
+                return downloader.download_annotation(obj_id, target)
+        except (NonZeroReturnCode, omero.ClientError, omero.ServerError,
+                OSError, Ice.Exception) as err:
+            action = "exported" if kind == "export" else "downloaded"
+            if ignore_errors:
+                logger.warning(f"{target} could not be {action} ({err}), "
+                               "ignoring.")
+                return None
+            if isinstance(err, (OSError, Ice.LocalException)):
+                # local disk or connection problem
+                logger.warning(f"{target} could not be {action}: {err}")
+            else:
+                logger.warning(f"A file could not be {action} - this is "
+                               "generally due to a server not allowing "
+                               "binary downloads.")
+            raise NonZeroReturnCode(1, "Download not allowed")
+
+    def _run_copy_jobs(self, jobs: List[Tuple[str, Any, str]],
+                       ignore_errors: bool, conn: BlitzGateway,
+                       workers: int, block_size: int,
+                       checkpoint: Optional[PackCheckpoint] = None):
+        def run(cli, downloader, job):
+            files = self._run_copy_job(cli, downloader, job, ignore_errors,
+                                       conn.c)
+            if checkpoint is not None and files is not None:
+                checkpoint.record(job, files)
+
+        def close(downloader):
+            downloader.close()
+            downloader.client.closeSession()
+
+        run_in_workers(run, jobs, workers,
+                       lambda: RawFileDownloader(conn.c.createClient(True),
+                                                 block_size),
+                       close)
+
+    def _package_files(self, dest_path: str, folder: str,
+                       archive: Optional[ArchiveWriter] = None):
+        ext = os.path.splitext(dest_path)[1]
+        if ext in (".tar", ".zip"):
+            if archive is None:
+                logger.info(f"Creating {ext[1:]} file...")
+                archive = ArchiveWriter(str(dest_path), folder)
+            else:
+                logger.info(f"Finishing {ext[1:]} file...")
+            archive.add_tree()
+            archive.close()
             logger.info("Cleaning up...")
             shutil.rmtree(folder)
         else:
@@ -474,9 +1096,6 @@ class TransferControl(GraphControl):
                             os.path.join(str(Path(folder)), path2))
         if os.path.exists(os.path.join(str(Path(folder)), "pixel_images")):
             shutil.rmtree(os.path.join(str(Path(folder)), "pixel_images"))
-        with open(filepath, 'w') as fp:
-            print(to_xml(newome), file=fp)
-            fp.close()
         return newome
 
     def __parse_objects(self, args):
@@ -524,10 +1143,24 @@ class TransferControl(GraphControl):
             raise ValueError("Only one special export type (RO-Crate, Bioimage"
                              " Archive, human-readable) can be specified at "
                              "once")
+        if args.stream:
+            if args.binaries == "none" or \
+               os.path.splitext(args.filepath)[1] not in (".tar", ".zip"):
+                raise ValueError("`--stream` can only be used to write a "
+                                 ".tar or .zip pack with binaries")
+            if any(export_types) or args.plugin:
+                raise ValueError("`--stream` cannot be combined with special "
+                                 "export types or plugins")
+            if args.resume:
+                raise ValueError("`--stream` packs cannot be resumed")
         self.metadata = []
         self._process_metadata(args.metadata)
+        provenance = None
+        if self.metadata:
+            provenance = create_provenance_context(self.gateway)
         path_id_dict = {}
         ome = OME()
+        writer = None
         for dataid in src_dataids:
             obj = self.gateway.getObject(src_datatype, dataid)
             if obj is None:
@@ -549,25 +1182,47 @@ class TransferControl(GraphControl):
             else:
                 md_fp = str(Path(folder) / "transfer.xml")
                 logger.info(f"Saving metadata at {md_fp}.")
+            if writer is None and not (args.simple or args.barchive):
+                writer = OMEWriter(md_fp)
             this_ome, this_id_dict = populate_xml(src_datatype, dataid, md_fp,
                                                   self.gateway, self.hostname,
                                                   args.barchive, args.simple,
                                                   args.figure,
-                                                  self.metadata)
+                                                  self.metadata, provenance,
+                                                  writer)
             ome = self.__append_to_ome(ome, this_ome)
             path_id_dict.update(this_id_dict)
             # need to somehow merge omes/path_id_dicts
-        if not args.barchive:
-            with open(md_fp, 'w') as fp:
-                print(to_xml(ome), file=fp)
-                fp.close()
+        if writer is not None:
+            # written before downloading, so that a staging folder kept
+            # for --resume already holds its metadata
+            writer.write(ome)
+        archive = None
         if args.binaries == "all":
             logger.info("Starting file copy...")
-            self._copy_files(path_id_dict, folder, args.ignore_errors,
-                             self.gateway)
+            block_size = args.block_size * 1024 * 1024
+            checkpoint = None
+            if args.stream:
+                archive = ArchiveWriter(str(tar_path), folder, block_size)
+            elif args.resume:
+                checkpoint = PackCheckpoint(folder, resume=True)
+            if checkpoint is None:
+                # a manifest left by an earlier --resume run is stale now
+                PackCheckpoint(folder).remove()
+            try:
+                self._copy_files(path_id_dict, folder, args.ignore_errors,
+                                 self.gateway, args.workers, block_size,
+                                 archive, checkpoint)
+            except BaseException:
+                if archive is not None:
+                    archive.discard()
+                raise
+            if checkpoint is not None:
+                checkpoint.remove()
 
         if args.simple:
-            self._fix_pixels_image_simple(ome, folder, md_fp)
+            xml_ome = self._fix_pixels_image_simple(ome, folder, md_fp)
+            write_ome_xml(xml_ome, md_fp)
         if args.barchive:
             logger.info(f"Creating Bioimage Archive TSV at {md_fp}.")
             populate_tsv(src_datatype, ome, md_fp,
@@ -606,7 +1261,7 @@ class TransferControl(GraphControl):
                     image_filenames_mapping=path_id_dict,
                     conn=self.gateway)
         elif args.binaries == "all":
-            self._package_files(tar_path, folder)
+            self._package_files(tar_path, folder, archive)
         return
 
     def __unpack(self, args):
@@ -614,30 +1269,40 @@ class TransferControl(GraphControl):
         self._process_metadata(args.metadata)
         if not args.folder:
             logger.info(f"Unzipping {args.filepath}...")
-            hash, ome, folder = self._load_from_pack(args.filepath,
-                                                     args.output)
+            hash, ome, folder = self._load_from_pack(
+                args.filepath, args.output, args.read_buffer * 1024 * 1024)
         else:
             folder = Path(args.filepath)
             ome = from_xml(folder / "transfer.xml")
             hash = "imported from folder"
         logger.info("Generating Image mapping and import filelist...")
-        ome, src_img_map, filelist = self._create_image_map(ome)
+        server_paths = ServerPathIndex.from_ome(ome)
+        ome, src_img_map, filelist = self._create_image_map(ome,
+                                                            server_paths)
         logger.info("Importing data as orphans...")
         if args.ln_s_import:
             ln_s = True
         else:
             ln_s = False
         dest_img_map = self._import_files(folder, filelist,
-                                          ln_s, args.skip, self.gateway)
+                                          ln_s, args.skip, self.gateway,
+                                          args.import_workers)
         self._delete_all_rois(dest_img_map, self.gateway)
         logger.info("Matching source and destination images...")
-        img_map = self._make_image_map(src_img_map, dest_img_map, self.gateway)
+        # destination IDs come straight from the imports, so there are no
+        # previously transferred images to filter out
+        img_map = self._make_image_map(src_img_map, dest_img_map)
         logger.info("Creating and linking OMERO objects...")
+        # imported plates, keyed like the server paths in transfer.xml
+        plate_paths = {k.split("/./")[-1].strip('/'): v
+                       for k, v in self.dest_plate_map.items()}
         populate_omero(ome, img_map, self.gateway,
-                       hash, folder, self.metadata, args.merge, args.figure)
+                       hash, folder, self.metadata, args.merge, args.figure,
+                       server_paths, plate_paths)
         return
 
-    def _load_from_pack(self, filepath: str, output: Optional[str] = None
+    def _load_from_pack(self, filepath: str, output: Optional[str] = None,
+                        buf_size: int = READ_BUF_SIZE
                         ) -> Tuple[str, OME, Path]:
         if (not filepath) or (not isinstance(filepath, str)):
             raise TypeError("filepath must be a string")
@@ -650,87 +1315,180 @@ class TransferControl(GraphControl):
         else:
             folder = parent_folder / filename
         if Path(filepath).exists():
-            with open(filepath, 'rb') as file:
-                md5 = hashlib.md5()
-                while True:
-                    data = file.read(MD5_BUF_SIZE)
-                    if not data:
-                        break
-                    md5.update(data)
-                hash = md5.hexdigest()
+            hash = read_md5_sidecar(filepath)
             if Path(filepath).suffix == '.zip':
-                with ZipFile(filepath, 'r') as zipobj:
-                    zipobj.extractall(str(folder))
+                # zip members are read out of order, so unless the pack
+                # came with its digest, it is computed in its own pass,
+                # alongside the extraction
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    md5 = None
+                    if hash is None:
+                        md5 = pool.submit(file_md5, filepath, buf_size)
+                    with open(filepath, 'rb', buffering=buf_size) as file, \
+                         ZipFile(file, 'r') as zipobj:
+                        zipobj.extractall(str(folder))
+                    digest = hash if md5 is None else md5.result()
             elif Path(filepath).suffix == '.tar':
-                shutil.unpack_archive(filepath, str(folder), 'tar')
+                # hash the tar while it is being extracted
+                with open(filepath, 'rb', buffering=buf_size) as file:
+                    reader = _HashingReader(file)
+                    with tarfile.open(fileobj=reader, mode='r|',
+                                      bufsize=buf_size) as tar:
+                        if hasattr(tarfile, "data_filter"):
+                            tar.extractall(str(folder), filter="data")
+                        else:
+                            tar.extractall(str(folder))
+                    while reader.read(buf_size):
+                        pass
+                digest = reader.md5.hexdigest()
             else:
                 raise ValueError("File is not a zip or tar file")
+            if hash is not None and hash != digest:
+                raise ValueError(f"{filepath} does not match the digest in "
+                                 f"{md5_sidecar_path(filepath)}; the pack "
+                                 "is corrupt or the .md5 file belongs to "
+                                 "another pack")
+            hash = digest
         else:
             raise FileNotFoundError("filepath is not a zip file")
         ome = from_xml(folder / "transfer.xml")
         return hash, ome, folder
 
-    def _create_image_map(self, ome: OME
+    def _create_image_map(self, ome: OME,
+                          server_paths: Optional[ServerPathIndex] = None
                           ) -> Tuple[OME, DefaultDict, List[str]]:
         if not (isinstance(ome, OME)):
             raise TypeError("XML is not valid OME format")
+        if server_paths is None:
+            server_paths = ServerPathIndex.from_ome(ome)
         img_map = DefaultDict(list)
         filelist = []
-        newome = copy.deepcopy(ome)
-        map_ref_ids = []
+        map_ref_ids = set()
         for img in ome.images:
-            fpath = get_server_path(img.annotation_refs,
-                                    ome.structured_annotations)
+            fpath = server_paths.object_path(img.id)
             img_map[fpath].append(int(img.id.split(":")[-1]))
             # use XML path annotation instead
             if fpath.endswith('mock_folder'):
                 filelist.append(fpath.rstrip("mock_folder"))
             else:
                 filelist.append(fpath)
-            for anref in img.annotation_refs:
-                for an in newome.structured_annotations:
-                    if anref.id == an.id and isinstance(an, XMLAnnotation):
-                        tree = ETree.fromstring(to_xml(an.value,
-                                                       canonicalize=True))
-                        for el in tree:
-                            if el.tag.rpartition('}')[2] == \
-                                    "CLITransferServerPath":
-                                newome.structured_annotations.remove(an)
-                                map_ref_ids.append(an.id)
-        for i in newome.images:
-            for ref in i.annotation_refs:
-                if ref.id in map_ref_ids:
-                    i.annotation_refs.remove(ref)
+            map_ref_ids.update(ref.id for ref in img.annotation_refs
+                               if server_paths.is_server_path(ref.id))
+        # shallow copies: only images that referenced a path annotation
+        # and the annotation list itself differ from the source OME
+        images = []
+        for img in ome.images:
+            refs = [ref for ref in img.annotation_refs
+                    if ref.id not in map_ref_ids]
+            if len(refs) != len(img.annotation_refs):
+                img = img.model_copy(update={"annotation_refs": refs})
+            images.append(img)
+        anns = StructuredAnnotations()
+        anns.extend(an for an in ome.structured_annotations
+                    if an.id not in map_ref_ids)
+        newome = ome.model_copy(update={"images": images,
+                                        "structured_annotations": anns})
         filelist = list(set(filelist))
         img_map = DefaultDict(list, {x: sorted(img_map[x])
                               for x in img_map.keys()})
         return newome, img_map, filelist
 
     def _import_files(self, folder: Path, filelist: List[str], ln_s: bool,
-                      skip: str, gateway: BlitzGateway) -> dict:
-        cli = CLI()
-        cli.loadplugins()
-        dest_map = {}
+                      skip: str, gateway: BlitzGateway,
+                      workers: int = 1) -> dict:
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("workers must be a positive integer")
         curr_folder = str(Path('.').resolve())
-        for filepath in filelist:
-            dest_path = str(os.path.join(curr_folder, folder,  '.', filepath))
-            command = ['import', dest_path]
-            if ln_s:
-                command.append('--transfer=ln_s')
-            if skip:
-                command.extend(['--skip', skip])
-            cli.invoke(command)
-            img_ids = self._get_image_ids(dest_path, gateway)
+        dest_paths = [str(os.path.join(curr_folder, folder,  '.', filepath))
+                      for filepath in filelist]
+        if workers == 1:
+            cli = CLI()
+            cli.loadplugins()
+            results = [self._import_file(cli, dest_path, ln_s, skip, gateway)
+                       for dest_path in dest_paths]
+            return self._collect_import_results(dest_paths, results)
+
+        def run(cli, worker_gateway, dest_path):
+            # the CLI closes its client once the command is done
+            cli.set_client(gateway.c.createClient(True))
+            return self._import_file(cli, dest_path, ln_s, skip,
+                                     worker_gateway)
+
+        results = run_in_workers(
+            run, dest_paths, workers,
+            lambda: BlitzGateway(client_obj=gateway.c.createClient(True)),
+            lambda worker_gateway: worker_gateway.close(hard=False))
+        return self._collect_import_results(dest_paths, results)
+
+    def _collect_import_results(self, dest_paths: List[str],
+                                results: List[Tuple[List[int], List[int]]]
+                                ) -> dict:
+        # Image IDs are returned, Plate IDs are kept in self.dest_plate_map
+        dest_map = {}
+        self.dest_plate_map = {}
+        for dest_path, (img_ids, plate_ids) in zip(dest_paths, results):
             dest_map[dest_path] = img_ids
+            if plate_ids:
+                self.dest_plate_map[dest_path] = plate_ids
         return dest_map
 
+    def _import_file(self, cli: CLI, dest_path: str, ln_s: bool, skip: str,
+                     gateway: BlitzGateway) -> Tuple[List[int], List[int]]:
+        # Have the importer report the IDs of what it created, rather than
+        # looking the new images up by client path afterwards
+        fd, out_path = tempfile.mkstemp(prefix="omero-import-",
+                                        suffix=".txt")
+        os.close(fd)
+        command = ['import', dest_path, '--output', 'ids', '--file', out_path]
+        if ln_s:
+            command.append('--transfer=ln_s')
+        if skip:
+            command.extend(['--skip', skip])
+        try:
+            cli.invoke(command)
+            with open(out_path) as fp:
+                img_ids, plate_ids = parse_import_ids(fp.read())
+        finally:
+            os.remove(out_path)
+        if plate_ids:
+            img_ids = sorted(set(img_ids) |
+                             set(self._get_plate_image_ids(plate_ids,
+                                                           gateway)))
+        elif not img_ids and cli.rv == 0:
+            # nothing reported for a successful import
+            img_ids = self._get_image_ids(dest_path, gateway)
+        return img_ids, plate_ids
+
+    def _get_plate_image_ids(self, plate_ids: List[int],
+                             conn: BlitzGateway) -> List[int]:
+        q = conn.getQueryService()
+        params = Parameters()
+        params.map = {"ids": rlist([rlong(i) for i in plate_ids])}
+        results = q.projection(
+            "SELECT ws.image.id FROM WellSample ws"
+            " WHERE ws.well.plate.id IN (:ids)",
+            params,
+            conn.SERVICE_OPTS
+            )
+        return [r[0].val for r in results]
+
     def _delete_all_rois(self, dest_map: dict, gateway: BlitzGateway):
-        roi_service = gateway.getRoiService()
-        for imgs in dest_map.values():
-            for img in imgs:
-                result = roi_service.findByImage(img, None)
-                for roi in result.rois:
-                    gateway.deleteObject(roi)
+        img_ids = [img for imgs in dest_map.values() for img in imgs]
+        if not img_ids:
+            return
+        roi_ids = find_ids_by_ids(gateway, "SELECT r.id FROM Roi r"
+                                           " WHERE r.image.id IN (:ids)",
+                                  img_ids)
+        for start in range(0, len(roi_ids), ROI_DELETE_BATCH_SIZE):
+            handle = gateway.deleteObjects(
+                "Roi", roi_ids[start:start + ROI_DELETE_BATCH_SIZE])
+            # large batches can take longer than deleteObjects(wait=True)
+            # is willing to wait for
+            try:
+                gateway.c.waitOnCmd(handle, loops=600, ms=1000,
+                                    failontimeout=True)
+            finally:
+                handle.close()
         return
 
     def _get_image_ids(self, file_path: str, conn: BlitzGateway) -> List[str]:
@@ -746,12 +1504,15 @@ class TransferControl(GraphControl):
         q = conn.getQueryService()
         params = Parameters()
         path_query = str(file_path).strip('/')
-        params.map = {"cpath": rstring('%s%%' % path_query)}
+        # the path itself or files below it: a bare prefix would also match
+        # e.g. `a/img2` for `a/img`, which may be a concurrent import
+        params.map = {"cpath": rstring(path_query),
+                      "cdir": rstring('%s/%%' % path_query)}
         results = q.projection(
             "SELECT i.id FROM Image i"
             " JOIN i.fileset fs"
             " JOIN fs.usedFiles u"
-            " WHERE u.clientPath LIKE :cpath",
+            " WHERE u.clientPath = :cpath OR u.clientPath LIKE :cdir",
             params,
             conn.SERVICE_OPTS
             )
@@ -772,8 +1533,7 @@ class TransferControl(GraphControl):
                     image_ids.append(img_id)
         return image_ids
 
-    def _make_image_map(self, source_map: dict, dest_map: dict,
-                        conn: Optional[BlitzGateway] = None) -> dict:
+    def _make_image_map(self, source_map: dict, dest_map: dict) -> dict:
         # using both source and destination file-to-image-id maps,
         # map image IDs between source and destination
         src_dict = DefaultDict(list)
@@ -796,24 +1556,10 @@ class TransferControl(GraphControl):
             src_v = src_dict[src_k]
             if src_k in dest_dict.keys():
                 dest_v = dest_dict[src_k]
-                clean_dest = []
-                if not conn:
-                    clean_dest = dest_v
-                else:
-                    for i in dest_v:
-                        img_obj = conn.getObject("Image", i)
-                        anns = 0
-                        for j in img_obj.listAnnotations():
-                            ns = j.getNs()
-                            if ns is not None and ns.startswith(
-                                    "openmicroscopy.org/cli/transfer"):
-                                anns += 1
-                        if not anns:
-                            clean_dest.append(i)
-                if len(src_v) == len(clean_dest):
+                if len(src_v) == len(dest_v):
                     for count in range(len(src_v)):
                         map_key = f"Image:{src_v[count]}"
-                        imgmap[map_key] = clean_dest[count]
+                        imgmap[map_key] = dest_v[count]
         return imgmap
 
     def __prepare(self, args):
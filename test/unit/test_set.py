@@ -6,12 +6,137 @@
 #
 # Use is subject to license terms supplied in LICENSE.
 
-from ome_types import from_xml
-from omero.cli import CLI
-from omero.gateway import BlitzGateway
-from omero_cli_transfer import TransferControl
+from ome_types import from_xml, to_xml
+from ome_types.model import OME, ROI, Mask, BinData
+from ome_types.model import Point as OMEPoint
+from ome_types.model import TagAnnotation, CommentAnnotation, MapAnnotation
+from ome_types.model import LongAnnotation, Map, AnnotationRef, Project
+from ome_types.model import Dataset, Plate, Well, Screen, WellSample
+from ome_types.model import DatasetRef
+from ome_types.model import ImageRef, XMLAnnotation
+from ome_types.model.map import M
+from ezomero import rois
+from omero.cli import CLI, NonZeroReturnCode
+from omero.gateway import BlitzGateway, ServiceOptsDict
+from omero.model import ImageI, PlateI, WellI, WellSampleI, OriginalFileI
+from omero.model import RoiI, FilesetI
+from omero.model import ImageAnnotationLinkI, TagAnnotationI, FileAnnotationI
+from omero.rtypes import rint, rlong, rstring, unwrap
+import omero_cli_transfer
+import generate_xml
+from omero_cli_transfer import TransferControl, ArchiveWriter
+from omero_cli_transfer import PackCheckpoint, parse_import_ids, file_md5
+from omero_cli_transfer import max_block_size, MESSAGE_OVERHEAD
+from generate_xml import OMEBuilder, PackCache, write_ome_xml, OMEWriter
+from generate_xml import load_annotations, create_provenance_metadata
+from generate_omero_objects import ServerPathIndex, get_server_path
+from generate_omero_objects import find_plates_by_path, contains_path
+from generate_omero_objects import create_shapes, create_omero_shape
+from generate_omero_objects import _rgba_to_int, _int_to_rgba
+from generate_omero_objects import parse_xml_metadata, create_annotations
+from generate_omero_objects import link_annotations, MergeIndex
+from generate_omero_objects import create_or_set_containers, rename_objects
+from generate_omero_objects import create_plate_from_images, create_well
+from generate_omero_objects import save_wells
+from generate_omero_objects import find_project, find_dataset, find_screen
 
+import Ice
 import pytest
+from dataclasses import replace
+import os
+import re
+import shutil
+import tarfile
+from zipfile import ZipFile
+from pathlib import Path
+from types import SimpleNamespace
+
+
+class StubQueryService():
+    """
+    Answers queries with the canned results of the first key found in the
+    query (callables are given the query parameters) and records every
+    query it runs, with its parameters.
+    """
+
+    def __init__(self, results=None):
+        self.results = results if results is not None else {}
+        self.queries = []
+        self.params = []
+
+    def _answer(self, query, params):
+        self.queries.append(query)
+        self.params.append(params)
+        for key, rows in self.results.items():
+            if key in query:
+                return rows(params) if callable(rows) else rows
+        return []
+
+    def findAllByQuery(self, query, params, ctx):
+        return self._answer(query, params)
+
+    def projection(self, query, params, ctx):
+        return self._answer(query, params)
+
+
+class StubUpdateService():
+    """Gives new objects an ID when they are saved and records each call."""
+
+    def __init__(self):
+        self.calls = []
+        self.next_id = 1000
+
+    def _save(self, objs):
+        for obj in objs:
+            if obj.getId() is None:
+                obj.setId(rlong(self.next_id))
+                self.next_id += 1
+        return objs
+
+    def saveAndReturnArray(self, objs, ctx):
+        self.calls.append(("saveAndReturnArray", list(objs)))
+        return self._save(list(objs))
+
+    def saveArray(self, objs, ctx):
+        self.calls.append(("saveArray", list(objs)))
+        self._save(list(objs))
+
+    def saveObject(self, obj, ctx):
+        self.calls.append(("saveObject", [obj]))
+        self._save([obj])
+
+    def saveAndReturnObject(self, obj, ctx):
+        self.calls.append(("saveAndReturnObject", [obj]))
+        return self._save([obj])[0]
+
+
+class StubConn():
+    """
+    Stands in for a BlitzGateway where only its services are used;
+    getObject finds nothing and records what it was asked for.
+    """
+
+    def __init__(self, results=None):
+        self.query = StubQueryService(results)
+        self.update = StubUpdateService()
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.fetched = []
+
+    def getQueryService(self):
+        return self.query
+
+    def getUpdateService(self):
+        return self.update
+
+    def getUser(self):
+        return SimpleNamespace(getId=lambda: 1, getName=lambda: "user")
+
+    def getUserId(self):
+        return 1
+
+    def getObject(self, obj_type, oid):
+        self.fetched.append((obj_type, oid))
+        return None
 
 
 class TestPackSide():
@@ -30,6 +155,9 @@ class TestPackSide():
             self.transfer._copy_files({'Image:12': 'test'}, 12, conn)
         with pytest.raises(TypeError):
             self.transfer._copy_files({'Image:12': 'test'}, "test_folder", 12)
+        with pytest.raises(ValueError):
+            self.transfer._copy_files({'Image:12': 'test'}, "test_folder",
+                                      conn, 0)
 
     def test_process_metadata(self):
         metadata = None
@@ -53,6 +181,347 @@ class TestPackSide():
         assert set(self.transfer.metadata) == \
             set(["timestamp", "software", "version"])
 
+    def test_ome_builder(self):
+        ome = from_xml('test/data/transfer.xml')
+        builder = OMEBuilder(ome)
+        img = ome.images[0]
+        assert builder.contains("images", img.id)
+        assert builder.get("images", img.id) is img
+        assert not builder.add("images", img)
+        assert len(builder.ome.images) == len(ome.images)
+        ann = ome.structured_annotations[0]
+        assert builder.contains("structured_annotations", ann.id)
+        assert not builder.contains("structured_annotations",
+                                    "Annotation:-1")
+
+    def test_write_ome_xml(self, tmp_path):
+        ome = from_xml('test/data/transfer.xml')
+        filepath = str(tmp_path / "transfer.xml")
+        write_ome_xml(ome, filepath)
+        with open(filepath) as fp:
+            assert fp.read() == to_xml(ome)
+        assert from_xml(filepath) == ome
+
+    def test_ome_writer(self, tmp_path):
+        ome = from_xml('test/data/transfer.xml')
+        filepath = str(tmp_path / "transfer.xml")
+        writer = OMEWriter(filepath)
+        builder = OMEBuilder(writer=writer)
+        for collection in OMEBuilder.INDEXED:
+            for obj in getattr(ome, collection):
+                builder.add(collection, obj)
+        # ROIs and annotations are written out as they are added; only
+        # the transfer XMLAnnotations stay in memory
+        assert builder.ome.rois == []
+        assert builder.contains("rois", ome.rois[0].id)
+        assert all(isinstance(ann, XMLAnnotation)
+                   for ann in builder.ome.structured_annotations)
+        assert len(builder.ome.structured_annotations) < \
+            len(ome.structured_annotations)
+        writer.write(builder.ome)
+        with open(filepath) as fp:
+            assert fp.read() == to_xml(ome)
+
+    def test_load_annotations(self):
+        tag = TagAnnotationI(5, True)
+        tag.setTextValue(rstring("tag"))
+        file_ann = FileAnnotationI(6, True)
+        links = []
+        for parent, child in [(1, tag), (2, tag), (2, file_ann)]:
+            link = ImageAnnotationLinkI()
+            link.setParent(ImageI(parent, False))
+            link.setChild(child)
+            links.append(link)
+        # file annotations are loaded again with their OriginalFile
+        loaded = FileAnnotationI(6, True)
+        loaded.setFile(OriginalFileI(7, True))
+        conn = StubConn({"FROM ImageAnnotationLink l": links,
+                         "FROM FileAnnotation a": [loaded]})
+        index = load_annotations(conn, "Image", [1, 2, 3])
+        assert [ann.getId() for ann in index[1]] == [5]
+        assert [ann.getId() for ann in index[2]] == [5, 6]
+        assert index[3] == []
+        # shared annotations are wrapped once
+        assert index[1][0] is index[2][0]
+        assert index[1][0].getTextValue() == "tag"
+        assert index[2][1]._obj is loaded
+        assert len(conn.query.queries) == 2
+
+    def test_pack_cache(self):
+        plate = PlateI(1, True)
+        plate.setName(rstring("plate"))
+        image = ImageI(10, True)
+        image.setName(rstring("image"))
+        well = WellI(2, True)
+        well.setPlate(PlateI(1, False))
+        well.setRow(rint(0))
+        well.setColumn(rint(1))
+        sample = WellSampleI(3, True)
+        sample.setImage(image)
+        well.addWellSample(sample)
+        results = {"FROM Plate p": [plate], "FROM Well w": [well],
+                   "FROM Image i": [image]}
+        conn = StubConn(results)
+        cache = PackCache(conn)
+        cache.prefetch("Plate", [1])
+        queries = len(conn.query.queries)
+        wells = cache.list_children(cache.get_object("Plate", 1))
+        assert [w.getId() for w in wells] == [2]
+        assert (wells[0].getRow(), wells[0].getColumn()) == (0, 1)
+        assert wells[0].countWellSample() == 1
+        img_id = wells[0].getWellSample(0).getImage().getId()
+        img = cache.get_object("Image", img_id)
+        assert img.getName() == "image"
+        assert cache.list_fileset_images(img) == []
+        assert cache.original_filepaths(img_id) == []
+        assert cache.list_rois(img_id) == []
+        assert cache.list_annotations("Well", 2) == []
+        # the whole plate came from the prefetch queries
+        assert len(conn.query.queries) == queries
+        assert conn.fetched == []
+
+        # objects that were not prefetched are loaded once, with the same
+        # queries; images without a fileset are not looked up again
+        conn = StubConn(results)
+        cache = PackCache(conn)
+        img = cache.get_object("Image", 10)
+        assert img.getId() == 10
+        queries = len(conn.query.queries)
+        assert cache.list_fileset_images(img) == []
+        assert cache.original_filepaths(10) == []
+        assert len(conn.query.queries) == queries
+        assert cache.get_object("Well", 2) is None
+        assert conn.fetched == [("Well", 2)]
+
+    def test_pack_cache_rois(self, monkeypatch):
+        rois = []
+        for roi_id, img_id in [(30, 1), (31, 2), (32, 1)]:
+            roi = RoiI(roi_id, True)
+            roi.setImage(ImageI(img_id, False))
+            rois.append(roi)
+
+        def find_rois(params):
+            img_ids = unwrap(params.map["ids"])
+            return [roi for roi in rois
+                    if roi.getImage().getId().getValue() in img_ids]
+        conn = StubConn({"FROM Image i": [ImageI(1, True), ImageI(2, True)],
+                         "FROM Roi r": find_rois})
+        monkeypatch.setattr(generate_xml, "ROI_QUERY_BATCH_SIZE", 1)
+        cache = PackCache(conn)
+        cache.prefetch("Image", [1, 2])
+        queries = list(conn.query.queries)
+        assert sum("FROM Roi r" in query for query in queries) == 2
+        assert any("FROM RoiAnnotationLink l" in query for query in queries)
+        assert [r.getId().getValue() for r in cache.list_rois(1)] == [30, 32]
+        assert [r.getId().getValue() for r in cache.list_rois(2)] == [31]
+        assert cache.list_annotations("Roi", 31) == []
+        # nothing is loaded per image once the ROIs are prefetched
+        assert conn.query.queries == queries
+
+    def test_provenance_context(self):
+        class ProvenanceConn(StubConn):
+            users = 0
+
+            def getUser(self):
+                self.users += 1
+                return super().getUser()
+
+            def getGroupFromContext(self):
+                return SimpleNamespace(getName=lambda: "group")
+
+            def getConfigService(self):
+                return SimpleNamespace(getDatabaseUuid=lambda: "uuid")
+
+        conn = ProvenanceConn()
+        cache = PackCache(conn)
+        context = cache.provenance_context()
+        assert cache.provenance_context() is context
+        assert conn.users == 1
+        assert context["curr_user"] == "user"
+        assert context["curr_group"] == "group"
+        assert context["db_id"] == "uuid"
+        # with a context, no connection is needed at all
+        metadata = ["img_id", "orig_user", "db_id"]
+        kv, ref = create_provenance_metadata(None, 12, "host", metadata,
+                                             False, context)
+        assert ref.id == kv.id
+        assert parse_xml_metadata(kv, metadata, "hash") == \
+            [["origin_image_id", "12"], ["original_user", "user"],
+             ["database_id", "uuid"]]
+        assert create_provenance_metadata(None, 12, "host", None, False,
+                                          context) == (None, None)
+
+    def test_pack_cache_fileset_paths(self):
+        images = []
+        for img_id in (1, 2):
+            image = ImageI(img_id, True)
+            image.setFileset(FilesetI(20, False))
+            images.append(image)
+        rows = [[rlong(20), rstring("user_1/2024/"), rstring("a.tif")],
+                [rlong(20), rstring("user_1/2024/"), rstring("a.tif.meta")]]
+        conn = StubConn({"FROM Image i": images, "FROM Fileset f": rows})
+        cache = PackCache(conn)
+        cache.prefetch("Image", [1])
+        queries = len(conn.query.queries)
+        paths = ["user_1/2024/a.tif", "user_1/2024/a.tif.meta"]
+        assert cache.original_filepaths(1) == paths
+        # the other image of the fileset shares its paths
+        assert cache.original_filepaths(2) == paths
+        assert cache.common_root(2) == Path("user_1/2024")
+        fs_images = cache.list_fileset_images(cache.get_object("Image", 1))
+        assert [img.getId() for img in fs_images] == [1, 2]
+        assert len(conn.query.queries) == queries
+        assert sum("FROM Fileset f" in query
+                   for query in conn.query.queries) == 1
+
+    @pytest.mark.parametrize("ext", [".tar", ".zip"])
+    def test_archive_writer(self, tmp_path, ext):
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder / "pixel_images")
+        (folder / "transfer.xml").write_text("<OME/>")
+        # left by an earlier --resume run, never part of the pack
+        (folder / PackCheckpoint.FILENAME).write_text("{}\n")
+        data = os.urandom(1000)
+        archive = ArchiveWriter(str(tmp_path / ("pack" + ext)), str(folder),
+                                block_size=64)
+        img_path = str(folder / "pixel_images" / "1.tiff")
+        blocks = (data[i:i + 64] for i in range(0, len(data), 64))
+        archive.write_stream(img_path, len(data), blocks)
+        assert archive.contains(img_path)
+        archive.add_tree()
+        archive.close()
+        out = tmp_path / "out"
+        shutil.unpack_archive(str(tmp_path / ("pack" + ext)), str(out))
+        assert (out / "pixel_images" / "1.tiff").read_bytes() == data
+        assert (out / "transfer.xml").read_text() == "<OME/>"
+        assert not (out / PackCheckpoint.FILENAME).exists()
+
+    @pytest.mark.parametrize("resume", [False, True])
+    def test_copy_files_failure(self, tmp_path, monkeypatch, resume):
+        folder = str(tmp_path / "pack_folder")
+        os.makedirs(folder)
+        job = ("file", 12, os.path.join(folder, "annotations", "12.txt"))
+
+        def fail(*args, **kwargs):
+            raise NonZeroReturnCode(1, "Download not allowed")
+        monkeypatch.setattr(self.transfer, "_list_copy_jobs",
+                            lambda *args: [job])
+        monkeypatch.setattr(self.transfer, "_run_copy_job", fail)
+        checkpoint = PackCheckpoint(folder, resume=True) if resume else None
+        with pytest.raises(NonZeroReturnCode):
+            self.transfer._copy_files({'Annotation:12': 'annotations/12.txt'},
+                                      folder, False, BlitzGateway(),
+                                      checkpoint=checkpoint)
+        # the staging folder is only kept for packs that can be resumed
+        assert os.path.exists(folder) == resume
+
+    @pytest.mark.parametrize("fail", [False, True])
+    def test_run_copy_jobs(self, tmp_path, monkeypatch, fail):
+        class WorkerClient():
+            def __init__(self):
+                self.closed = False
+
+            def createClient(self, secure):
+                return WorkerClient()
+
+            def closeSession(self):
+                self.closed = True
+
+        class WorkerDownloader():
+            def __init__(self, client, block_size, archive=None):
+                self.client = client
+                self.closed = False
+                downloaders.append(self)
+
+            def close(self):
+                self.closed = True
+
+        class WorkerCLI():
+            def loadplugins(self):
+                pass
+
+        downloaders = []
+        done = []
+
+        def run_job(cli, downloader, job, ignore_errors, client=None):
+            if fail and job[1] == 3:
+                raise NonZeroReturnCode(1, "Download not allowed")
+            with open(job[2], "w") as fp:
+                fp.write("x")
+            done.append(job)
+            return [(job[2], 1, None)]
+        monkeypatch.setattr(omero_cli_transfer, "CLI", WorkerCLI)
+        monkeypatch.setattr(omero_cli_transfer, "RawFileDownloader",
+                            WorkerDownloader)
+        monkeypatch.setattr(self.transfer, "_run_copy_job", run_job)
+        jobs = [("file", i, str(tmp_path / f"{i}.txt")) for i in range(8)]
+        checkpoint = PackCheckpoint(str(tmp_path))
+        conn = SimpleNamespace(c=WorkerClient())
+        if fail:
+            with pytest.raises(NonZeroReturnCode):
+                self.transfer._run_copy_jobs(jobs, False, conn, 4, 1024,
+                                             checkpoint)
+        else:
+            self.transfer._run_copy_jobs(jobs, False, conn, 4, 1024,
+                                         checkpoint)
+            assert sorted(done) == jobs
+        # every job that ran was recorded; each worker had its own client,
+        # which is closed once the pool is done
+        assert all(checkpoint.is_done(job) for job in done)
+        assert 1 <= len(downloaders) <= 4
+        assert len(set(id(d.client) for d in downloaders)) == len(downloaders)
+        assert all(d.closed and d.client.closed for d in downloaders)
+
+    def test_max_block_size(self):
+        class FakeClient():
+            def __init__(self, value):
+                self.value = value
+
+            def getProperty(self, key):
+                assert key == "Ice.MessageSizeMax"
+                return self.value
+
+        assert max_block_size(None) is None
+        assert max_block_size(FakeClient("")) is None
+        assert max_block_size(FakeClient("0")) is None
+        assert max_block_size(FakeClient("65536")) == \
+            64 * 1024 * 1024 - MESSAGE_OVERHEAD
+
+    @pytest.mark.parametrize("error", [OSError(28, "No space left"),
+                                       Ice.ConnectionLostException()])
+    def test_copy_job_local_errors(self, tmp_path, error):
+        class FailingDownloader():
+            archive = None
+
+            def download_annotation(self, ann_id, target):
+                raise error
+
+        job = ("file", 12, str(tmp_path / "12.txt"))
+        assert self.transfer._run_copy_job(None, FailingDownloader(), job,
+                                           True) is None
+        with pytest.raises(NonZeroReturnCode):
+            self.transfer._run_copy_job(None, FailingDownloader(), job,
+                                        False)
+
+    def test_pack_checkpoint(self, tmp_path):
+        job = ("file", 12, str(tmp_path / "annotations" / "12.txt"))
+        os.makedirs(tmp_path / "annotations")
+        with open(job[2], "w") as fp:
+            fp.write("data")
+        checkpoint = PackCheckpoint(str(tmp_path))
+        assert not checkpoint.is_done(job)
+        checkpoint.record(job, [(job[2], 4, file_md5(job[2]))])
+        assert PackCheckpoint(str(tmp_path), resume=True).is_done(job)
+        with open(job[2], "w") as fp:
+            fp.write("partial")
+        assert not PackCheckpoint(str(tmp_path), resume=True).is_done(job)
+        # same size, different content
+        with open(job[2], "w") as fp:
+            fp.write("date")
+        assert not PackCheckpoint(str(tmp_path), resume=True).is_done(job)
+        PackCheckpoint(str(tmp_path))
+        assert not os.path.exists(tmp_path / PackCheckpoint.FILENAME)
+
 
 class TestUnpackSide():
     def setup_method(self):
@@ -82,6 +551,65 @@ class TestUnpackSide():
         assert str(folder.resolve()) == \
             "/omero-cli-transfer/test/data/valid_single_image"
 
+    @pytest.mark.parametrize("ext", [".tar", ".zip"])
+    @pytest.mark.parametrize("dir_entries", [True, False])
+    def test_load_pack_round_trip(self, tmp_path, ext, dir_entries):
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder / "pixel_images")
+        (folder / "transfer.xml").write_text(to_xml(OME()))
+        (folder / "pixel_images" / "1.tiff").write_bytes(b"tiff")
+        filepath = str(tmp_path / ("pack" + ext))
+        if dir_entries:
+            archive = ArchiveWriter(filepath, str(folder))
+            archive.add_tree()
+            archive.close()
+        elif ext == ".zip":
+            with ZipFile(filepath, "w") as zipobj:
+                zipobj.write(folder / "transfer.xml", "transfer.xml")
+                zipobj.write(folder / "pixel_images" / "1.tiff",
+                             "pixel_images/1.tiff")
+        else:
+            with tarfile.open(filepath, "w") as tar:
+                tar.add(folder / "transfer.xml", "./transfer.xml")
+                tar.add(folder / "pixel_images" / "1.tiff",
+                        "./pixel_images/1.tiff")
+        out = tmp_path / "out"
+        hash, ome, folder = self.transfer._load_from_pack(filepath, str(out))
+        assert hash == file_md5(filepath)
+        assert ome == OME()
+        assert (out / "pixel_images" / "1.tiff").read_bytes() == b"tiff"
+
+    def _write_pack_with_sidecar(self, tmp_path, ext, digest):
+        folder = tmp_path / "pack_folder"
+        os.makedirs(folder)
+        (folder / "transfer.xml").write_text(to_xml(OME()))
+        filepath = str(tmp_path / ("pack" + ext))
+        archive = ArchiveWriter(filepath, str(folder))
+        archive.add_tree()
+        archive.close()
+        sidecar = filepath + ".md5"
+        with open(sidecar, "w") as fp:
+            fp.write(f"{digest}  pack{ext}\n")
+        return filepath, sidecar
+
+    def test_load_tar_wrong_sidecar(self, tmp_path):
+        filepath, sidecar = self._write_pack_with_sidecar(
+            tmp_path, ".tar", "0" * 32)
+        with pytest.raises(ValueError, match=re.escape(sidecar)):
+            self.transfer._load_from_pack(filepath, str(tmp_path / "out"))
+
+    def test_load_zip_uses_sidecar(self, tmp_path, monkeypatch):
+        filepath, _ = self._write_pack_with_sidecar(
+            tmp_path, ".zip", "0" * 32)
+
+        def no_hashing(*args, **kwargs):
+            raise AssertionError("zip pack hashed despite its .md5 file")
+        monkeypatch.setattr(omero_cli_transfer, "file_md5", no_hashing)
+        hash, ome, _ = self.transfer._load_from_pack(
+            filepath, str(tmp_path / "out"))
+        assert hash == "0" * 32
+        assert ome == OME()
+
     def test_non_existing_file(self):
         with pytest.raises(FileNotFoundError):
             self.transfer._load_from_pack('data/fake_file.zip',
@@ -116,6 +644,335 @@ class TestUnpackSide():
         #                   filelist[0]))], int)
         assert True
 
+    def test_server_path_index(self):
+        ome = from_xml('test/data/transfer.xml')
+        index = ServerPathIndex.from_ome(ome)
+        for img in ome.images:
+            path = get_server_path(img.annotation_refs,
+                                   ome.structured_annotations)
+            assert index.object_path(img.id) == path
+            assert index.get(img.annotation_refs) == path
+            assert any(index.is_server_path(ref.id)
+                       for ref in img.annotation_refs)
+        assert index.object_path("Image:-1") is None
+        assert not index.is_metadata(ome.structured_annotations[0].id)
+
+    def test_import_files_workers(self, monkeypatch):
+        class FakeClient():
+            def createClient(self, secure):
+                return FakeClient()
+
+        class FakeGateway(StubConn):
+            def __init__(self, client_obj=None):
+                super().__init__()
+                self.c = client_obj or FakeClient()
+
+            def close(self, hard=True):
+                pass
+
+        def fake_import(cli, dest_path, ln_s, skip, gateway):
+            assert gateway is not main_gateway
+            n = int(dest_path.rsplit("img", 1)[-1])
+            return [n], [100 + n] if n % 2 else []
+
+        monkeypatch.setattr(omero_cli_transfer, "BlitzGateway", FakeGateway)
+        monkeypatch.setattr(self.transfer, "_import_file", fake_import)
+        main_gateway = FakeGateway()
+        filelist = [f"a/img{i}" for i in range(6)]
+        dest_map = self.transfer._import_files(Path("folder"), filelist,
+                                               False, None, main_gateway, 3)
+        assert [k.split("/./")[-1] for k in dest_map] == filelist
+        assert list(dest_map.values()) == [[i] for i in range(6)]
+        assert sorted(self.transfer.dest_plate_map.values()) == \
+            [[101], [103], [105]]
+
+    def test_get_image_ids_query(self):
+        conn = StubConn()
+        assert self.transfer._get_image_ids("/data/./a/img", conn) == []
+        params = conn.query.params[0]
+        assert unwrap(params.map["cpath"]) == "data/./a/img"
+        assert unwrap(params.map["cdir"]) == "data/./a/img/%"
+
+    def test_find_plates_by_path(self):
+        conn = StubConn({"FROM Plate p": [
+            [rlong(1), rstring("/data/plate1/a.tif")],
+            [rlong(2), rstring("/data/plate10/a.tif")],
+            [rlong(3), rstring("/data/x/plate1")]]})
+        found = find_plates_by_path(["plate1", "plate10", "data/x"], conn)
+        assert found == {"plate1": {1, 3}, "plate10": {2}, "data/x": {3}}
+        assert contains_path("/data/plate1/a.tif", "/plate1/")
+        assert not contains_path("/data/plate10/a.tif", "plate1")
+        assert not contains_path("/data/plate1/a.tif", "")
+
+    @pytest.mark.parametrize("shape, fields", [
+        (rois.Point(1.0, 2.0, z=0, c=1, t=2, label="pt"),
+         {"getX": 1.0, "getY": 2.0, "getTheZ": 0, "getTheC": 1,
+          "getTheT": 2, "getTextValue": "pt"}),
+        (rois.Line(1.0, 2.0, 3.0, 4.0, markerEnd="Arrow"),
+         {"getX1": 1.0, "getY1": 2.0, "getX2": 3.0, "getY2": 4.0,
+          "getMarkerStart": None, "getMarkerEnd": "Arrow"}),
+        (rois.Rectangle(1.0, 2.0, 3.0, 4.0),
+         {"getX": 1.0, "getY": 2.0, "getWidth": 3.0, "getHeight": 4.0}),
+        (rois.Ellipse(1.0, 2.0, 3.0, 4.0),
+         {"getX": 1.0, "getY": 2.0, "getRadiusX": 3.0, "getRadiusY": 4.0}),
+        (rois.Polygon([(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)]),
+         {"getPoints": "1.0,2.0 3.0,4.0 5.0,6.0"}),
+        (rois.Polyline([(1.0, 2.0), (3.0, 4.0)]),
+         {"getPoints": "1.0,2.0 3.0,4.0"}),
+        (rois.Label(1.0, 2.0, "text", 12),
+         {"getX": 1.0, "getY": 2.0, "getTextValue": "text"}),
+    ])
+    def test_create_omero_shape(self, shape, fields):
+        colored = replace(shape, fill_color=(255, 0, 0, 128),
+                          stroke_color=(0, 255, 255, 255), stroke_width=2.0)
+        omero_shape = create_omero_shape(colored)
+        for getter, value in fields.items():
+            assert unwrap(getattr(omero_shape, getter)()) == value
+        assert _int_to_rgba(unwrap(omero_shape.getFillColor())) == \
+            (255, 0, 0, 128)
+        assert _int_to_rgba(unwrap(omero_shape.getStrokeColor())) == \
+            (0, 255, 255, 255)
+        assert omero_shape.getStrokeWidth().getValue() == 2.0
+        # colors left unset get ezomero's defaults
+        omero_shape = create_omero_shape(shape)
+        assert unwrap(omero_shape.getFillColor()) == 0
+        assert _int_to_rgba(unwrap(omero_shape.getStrokeColor())) == \
+            (255, 255, 0, 255)
+        assert omero_shape.getStrokeWidth().getValue() == 1.0
+
+    def test_create_omero_shape_mask(self):
+        # ezomero has no mask shape, so masks are not transferred
+        roi = ROI(union=[Mask(x=0, y=0, width=2, height=2,
+                              bin_data=BinData(value=b"AA==", length=1,
+                                               big_endian=False)),
+                         OMEPoint(x=1, y=2)])
+        shapes = create_shapes(roi)
+        assert len(shapes) == 1
+        assert isinstance(shapes[0], rois.Point)
+        with pytest.raises(TypeError):
+            create_omero_shape(roi.union[0])
+
+    @pytest.mark.parametrize("color", [(0, 0, 0, 0), (255, 255, 0, 255),
+                                       (255, 255, 255, 255), (1, 2, 3, 4),
+                                       (128, 0, 0, 0)])
+    def test_rgba_round_trip(self, color):
+        value = _rgba_to_int(color)
+        assert -2**31 <= value < 2**31
+        assert _int_to_rgba(value) == color
+
+    def test_delete_all_rois(self, monkeypatch):
+        class DeleteConn(StubConn):
+            def __init__(self, results):
+                super().__init__(results)
+                self.deleted = []
+                self.waited = []
+                self.c = SimpleNamespace(
+                    waitOnCmd=lambda handle, **kwargs:
+                    self.waited.append(handle))
+
+            def deleteObjects(self, obj_type, ids, **kwargs):
+                self.deleted.append((obj_type, list(ids)))
+                return Handle(len(self.deleted))
+
+        class Handle():
+            def __init__(self, id):
+                self.id = id
+                self.closed = False
+
+            def close(self):
+                self.closed = True
+
+        monkeypatch.setattr(omero_cli_transfer, "ROI_DELETE_BATCH_SIZE", 2)
+        conn = DeleteConn({"FROM Roi r": [[rlong(i)] for i in range(5)]})
+        self.transfer._delete_all_rois({"a": [1, 2], "b": [3]}, conn)
+        assert len(conn.query.queries) == 1
+        assert conn.deleted == [("Roi", [0, 1]), ("Roi", [2, 3]),
+                                ("Roi", [4])]
+        # every request is waited on, and its handle closed
+        assert [handle.id for handle in conn.waited] == [1, 2, 3]
+        assert all(handle.closed for handle in conn.waited)
+        conn = DeleteConn({})
+        self.transfer._delete_all_rois({}, conn)
+        assert conn.query.queries == [] and conn.deleted == []
+
+    def test_create_annotations(self):
+        ans = [TagAnnotation(id="Annotation:1", value="tag"),
+               CommentAnnotation(id="Annotation:2", value="comment"),
+               MapAnnotation(id="Annotation:3", namespace="ns",
+                             value=Map(ms=[M(k="a", value="b")])),
+               LongAnnotation(id="Annotation:4", value=7)]
+        conn = StubConn()
+        ann_map = create_annotations(ans, conn, "hash", "folder", False, {},
+                                     [], batch_size=3)
+        calls = conn.update.calls
+        assert [(name, len(objs)) for name, objs in calls] == \
+            [("saveAndReturnArray", 3), ("saveAndReturnArray", 1)]
+        saved = [obj for _, objs in calls for obj in objs]
+        assert ann_map == {ann.id: obj.getId().getValue()
+                           for ann, obj in zip(ans, saved)}
+        assert unwrap(saved[0].getTextValue()) == "tag"
+        assert unwrap(saved[1].getTextValue()) == "comment"
+        assert unwrap(saved[2].getNs()) == "ns"
+        assert [(m.name, m.value) for m in saved[2].getMapValue()] == \
+            [("a", "b")]
+        assert unwrap(saved[3].getLongValue()) == 7
+
+    def test_link_annotations(self):
+        tag = TagAnnotation(id="Annotation:1", value="tag")
+        comment = CommentAnnotation(id="Annotation:2", value="comment")
+        tag_ref = AnnotationRef(id=tag.id)
+        comment_ref = AnnotationRef(id=comment.id)
+        # Annotation:3 was not created on unpack (e.g. a file path)
+        ome = OME(projects=[Project(id="Project:1", name="p",
+                                    annotation_refs=[tag_ref, tag_ref])],
+                  datasets=[Dataset(id="Dataset:1", name="d",
+                                    annotation_refs=[
+                                        tag_ref, comment_ref,
+                                        AnnotationRef(id="Annotation:3")])],
+                  plates=[Plate(id="Plate:1",
+                                wells=[Well(id="Well:1", row=0, column=1,
+                                            annotation_refs=[comment_ref])])],
+                  structured_annotations=[tag, comment])
+        ann_map = {tag.id: 10, comment.id: 11}
+        conn = StubConn({"FROM Well w": [[rlong(5), rint(0), rint(1),
+                                          rlong(50)]]})
+        link_annotations(ome, {"Project:1": 100}, {"Dataset:1": 200}, {},
+                         ann_map, {}, {"Plate:1": 5}, conn, batch_size=3)
+        calls = conn.update.calls
+        assert [(name, len(objs)) for name, objs in calls] == \
+            [("saveArray", 3), ("saveArray", 1)]
+        links = [(type(link).__name__, link.getParent().getId().getValue(),
+                  type(link.getChild()).__name__,
+                  link.getChild().getId().getValue())
+                 for _, objs in calls for link in objs]
+        assert links == [
+            ("ProjectAnnotationLinkI", 100, "TagAnnotationI", 10),
+            ("DatasetAnnotationLinkI", 200, "TagAnnotationI", 10),
+            ("DatasetAnnotationLinkI", 200, "CommentAnnotationI", 11),
+            ("WellAnnotationLinkI", 50, "CommentAnnotationI", 11)]
+        # the well IDs of all plates come from a single query
+        assert len(conn.query.queries) == 1
+
+    def test_merge_index(self):
+        conn = StubConn({
+            "FROM Project p": [[rlong(1), rstring("p")],
+                               [rlong(2), rstring("p")]],
+            "FROM Dataset d": [[rlong(3), rstring("d"), rstring("p")],
+                               [rlong(4), rstring("d"), None]]})
+        index = MergeIndex(conn)
+        # as with the name scans it replaces, the last match wins
+        assert find_project(Project(id="Project:1", name="p"), index) == 2
+        assert find_project(Project(id="Project:1", name="q"), index) == 0
+        ds = Dataset(id="Dataset:1", name="d")
+        assert find_dataset(ds, ["x", "p"], index) == 3
+        assert find_dataset(ds, ["x"], index) == 0
+        # datasets outside of the pack's projects only match orphans
+        assert find_dataset(ds, [], index) == 4
+        assert find_screen(Screen(id="Screen:1", name="s"), index) == 0
+        index.add("Project", "q", 5)
+        assert find_project(Project(id="Project:1", name="q"), index) == 5
+        # one query per kind of container
+        assert len(conn.query.queries) == 3
+
+    def test_create_or_set_containers(self):
+        ome = OME(projects=[Project(id="Project:1", name="p"),
+                            Project(id="Project:2", name="p")],
+                  datasets=[Dataset(id="Dataset:1", name="d")],
+                  screens=[Screen(id="Screen:1", name="s")])
+        conn = StubConn()
+        proj_map, ds_map, scr_map = create_or_set_containers(ome, conn,
+                                                             False)
+        assert [(name, len(objs)) for name, objs in conn.update.calls] == \
+            [("saveAndReturnArray", 4)]
+        assert proj_map == {"Project:1": 1000, "Project:2": 1001}
+        assert ds_map == {"Dataset:1": 1002}
+        assert scr_map == {"Screen:1": 1003}
+
+        # when merging, existing containers are reused and new ones with
+        # the same name are only created once
+        ds_ref = DatasetRef(id="Dataset:3")
+        ome = OME(projects=[Project(id="Project:1", name="p",
+                                    dataset_refs=[ds_ref])],
+                  datasets=[Dataset(id="Dataset:1", name="d"),
+                            Dataset(id="Dataset:2", name="d"),
+                            Dataset(id="Dataset:3", name="e")])
+        conn = StubConn({"FROM Project p": [[rlong(7), rstring("p")]]})
+        index = MergeIndex(conn)
+        proj_map, ds_map, scr_map = create_or_set_containers(ome, conn, True,
+                                                             index)
+        assert proj_map == {"Project:1": 7}
+        assert ds_map == {"Dataset:1": 1000, "Dataset:2": 1000,
+                          "Dataset:3": 1001}
+        assert scr_map == {}
+        assert [(name, len(objs)) for name, objs in conn.update.calls] == \
+            [("saveAndReturnArray", 2)]
+        assert index.find("Dataset", "d") == 1000
+        # datasets of pack projects are indexed under their project
+        assert index.find("Dataset", "e", "p") == 1001
+        assert index.find("Dataset", "e") == 0
+
+    def test_rename_objects(self):
+        images = []
+        for img_id, name in [(1, "a"), (2, "old"), (3, "old")]:
+            image = ImageI(img_id, True)
+            image.setName(rstring(name))
+            images.append(image)
+
+        def find_images(params):
+            ids = unwrap(params.map["ids"])
+            return [img for img in images if img.getId().getValue() in ids]
+        conn = StubConn({"FROM Image o": find_images})
+        rename_objects("Image", {1: "a", 2: "b", 3: "c"}, conn, batch_size=2)
+        assert len(conn.query.queries) == 2
+        # only objects whose name changed are saved
+        assert [(name, [obj.getId().getValue() for obj in objs])
+                for name, objs in conn.update.calls] == \
+            [("saveArray", [2]), ("saveArray", [3])]
+        assert [unwrap(img.getName()) for img in images] == ["a", "b", "c"]
+        conn = StubConn()
+        rename_objects("Image", {}, conn)
+        assert conn.query.queries == [] and conn.update.calls == []
+
+    def test_create_plate_from_images(self):
+        class FailingUpdate(StubUpdateService):
+            # wells in row 1 cannot be saved
+            def saveArray(self, objs, ctx):
+                if any(unwrap(obj.row) == 1 for obj in objs):
+                    raise ValueError("invalid well")
+                super().saveArray(objs, ctx)
+
+            def saveObject(self, obj, ctx):
+                if unwrap(obj.row) == 1:
+                    raise ValueError("invalid well")
+                super().saveObject(obj, ctx)
+
+        wells = []
+        for img_id, (row, column) in enumerate([(0, 0), (0, 1), (1, 0)]):
+            sample = WellSample(id=f"WellSample:{img_id}", index=0,
+                                image_ref=ImageRef(id=f"Image:{img_id}"))
+            wells.append(Well(id=f"Well:{img_id}", row=row, column=column,
+                              well_samples=[sample]))
+        plate = Plate(id="Plate:1", name="plate", wells=wells)
+        img_map = {"Image:0": 10, "Image:1": 11, "Image:2": 12}
+        conn = StubConn()
+        conn.update = FailingUpdate()
+        plate_id = create_plate_from_images(plate, img_map, conn,
+                                            batch_size=2)
+        calls = conn.update.calls
+        assert calls[0][0] == "saveAndReturnObject"
+        assert plate_id == calls[0][1][0].getId().getValue()
+        # the first batch is saved at once, the failing one well by well
+        assert [(name, len(objs)) for name, objs in calls[1:]] == \
+            [("saveArray", 2)]
+        saved = calls[1][1]
+        assert [(unwrap(w.row), unwrap(w.column)) for w in saved] == \
+            [(0, 0), (0, 1)]
+        assert all(w.plate.getId().getValue() == plate_id for w in saved)
+        assert [[ws.image.getId().getValue() for ws in w.copyWellSamples()]
+                for w in saved] == [[10], [11]]
+        failed = save_wells([create_well([12], plate_id, 0, 1)], conn)
+        assert [(row, column) for row, column, _ in failed] == [(1, 0)]
+
     def test_image_map(self):
         path1 = 'c/d'
         path2 = 'c/d'
@@ -140,3 +997,10 @@ class TestUnpackSide():
         dest_map = {path2: [2, 7, 9, 14]}
         imgmap = self.transfer._make_image_map(src_map, dest_map)
         assert imgmap == {}
+
+    def test_parse_import_ids(self):
+        assert parse_import_ids("") == ([], [])
+        output = "Image:12,10,11\nPlate:3\n"
+        assert parse_import_ids(output) == ([10, 11, 12], [3])
+        output = "Fileset:1\nImage:5\nImage:4,5\n"
+        assert parse_import_ids(output) == ([4, 5], [])